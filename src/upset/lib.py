@@ -1,7 +1,9 @@
 """Library providing basic functionality and a base class for plugins."""
 
 import base64
+import concurrent.futures
 import dataclasses
+import functools
 import getpass
 import grp
 import json
@@ -16,12 +18,36 @@ import stat
 import string
 import subprocess
 import sys
+import tempfile
 
-from typing import Any, Optional
+from typing import Any, Callable, Iterator, Optional, Union
 
 logger: logging.Logger = logging.getLogger()
 logger.addHandler(logging.NullHandler())
 
+# let all ssh calls to the same user and host share one connection
+# instead of doing a handshake for each command
+# `%C` is a hash of the connection parameters so sockets do not collide
+# the master connection closes itself after 60 seconds without use
+_SSH_MULTIPLEXING: list[str] = [
+        '-o', 'ControlMaster=auto',
+        '-o', 'ControlPath=~/.ssh/upset-%C',
+        '-o', 'ControlPersist=60s']
+
+# characters that make a command line need a shell to be interpreted
+_SHELL_SPECIAL: re.Pattern = re.compile(r'[\s|&;<>()$`\\"\'*?\[\]#~=%{}!]')
+
+# characters that make a needle of `Fs.ensure_in_file()` a regular
+# expression rather than plain text
+_REGEX_SPECIAL: frozenset[str] = frozenset('.^$*+?{}[]|()\\')
+
+# the default of `Fs.ensure_in_file()` for appending to a file
+_INSERT_AT_END: re.Pattern = re.compile(rb'\Z')
+
+# permission strings that leave owner, group and mode as they are
+_KEEP_PERMISSIONS: tuple[str, ...] = ('-', '-,-,-')
+
+
 @dataclasses.dataclass
 class Template():
     """Holds a template string and its variables.
@@ -34,6 +60,70 @@ class Template():
     file: pathlib.Path
     substitutes: dict[str, str]
 
+class Lazy():
+    """Defer building an argument for a log message.
+
+    `logging` only formats a message if a handler takes the record, the
+    arguments however are built beforehand. Wrapping the work in `Lazy`
+    postpones it until the message is actually formatted.
+
+    E.g.::
+
+        logger.info('installing "%s"', Lazy(', '.join, packages))
+    """
+
+    def __init__(self, function: Callable[..., Any], *args: Any) -> None:
+        """Store the function and its arguments.
+
+        Args:
+            function: The function that builds the argument.
+            args: The arguments to call `function` with.
+        """
+        self._function: Callable[..., Any] = function
+        self._args: tuple[Any, ...] = args
+
+    def __str__(self) -> str:
+        """Build the argument.
+
+        Returns:
+            The result of the function as string.
+        """
+        return str(self._function(*self._args))
+
+def _first_line(text: str) -> str:
+    """Get the first line of a text, e.g., for logging.
+
+    Args:
+        text: The text.
+
+    Returns:
+        Everything up to the first `"\n"`.
+    """
+    return text.partition('\n')[0]
+
+# set by `configure_logging()` so plugins share one handler
+_logging_configured: bool = False
+
+def configure_logging() -> None:
+    """Log everything to the console (once per process).
+
+    Plugins call this when they are imported. Adding a handler for
+    each imported plugin would print every record several times.
+    """
+    # pylint: disable=global-statement
+    global _logging_configured
+    if _logging_configured:
+        return
+    _logging_configured = True
+    # create console handler and set level to debug
+    logging_handler: logging.StreamHandler = logging.StreamHandler()
+    logging_handler.setLevel(logging.DEBUG)
+    logging_handler.setFormatter(
+            logging.Formatter('%(levelname)s %(name)s %(message)s'))
+    root_logger: logging.Logger = logging.getLogger()
+    root_logger.setLevel(logging.DEBUG)
+    root_logger.addHandler(logging_handler)
+
 class UpsetError(Exception):
     """Custom exception."""
 
@@ -46,65 +136,362 @@ class UpsetFsError(UpsetError):
 class UpsetHelperError(UpsetError):
     """Error for Helper interactions."""
 
+@functools.lru_cache(maxsize=256)
+def _get_uid(name: str) -> int:
+    """Get the id of a user.
+
+    The result is cached as each lookup might have to go through NSS
+    (think LDAP) and the same few users are looked up over and over.
+
+    Args:
+        name: The name of the user.
+
+    Returns:
+        The user's id.
+    """
+    return pwd.getpwnam(name).pw_uid
+
+@functools.lru_cache(maxsize=256)
+def _get_gid(name: str) -> int:
+    """Get the id of a group (cached, see `_get_uid()`).
+
+    Args:
+        name: The name of the group.
+
+    Returns:
+        The group's id.
+    """
+    return grp.getgrnam(name).gr_gid
+
+@functools.lru_cache(maxsize=64)
+def _parse_permissions(permissions: str) -> tuple[str, str, str, int]:
+    """Split a permission string once (see `Fs.ensure_perms()`).
+
+    The same few permission strings are applied to many paths so the
+    split and the octal conversion are cached. Names are not resolved
+    here as they may change (see `Fs.forget_ids()`).
+
+    Args:
+        permissions: The permissions string, e.g. `"user1,group1,755"`.
+
+    Returns:
+        Owner, group, mode and the mode as integer (`-1` if the mode
+        is `"-"` or `"."`).
+
+    Raises:
+        UpsetFsError: If the string is malformed.
+    """
+    if permissions == '.':
+        return '.', '.', '.', -1
+    try:
+        owner, group, mode = permissions.split(',')
+        mode_bits: int = -1 if mode in ('-', '.') else int(mode, 8)
+    except ValueError as error:
+        raise UpsetFsError(
+                f'malformed permissions "{permissions}"') from error
+    return owner, group, mode, mode_bits
+
+@functools.lru_cache(maxsize=256)
+def _compile_regex(pattern: Union[str, bytes]) -> re.Pattern:
+    """Compile a regular expression only once.
+
+    `re` keeps its own cache but patterns built from user input easily
+    push each other out of it.
+
+    Args:
+        pattern: The regular expression (as string or bytes).
+
+    Returns:
+        The compiled pattern.
+    """
+    return re.compile(pattern)
+
+@functools.lru_cache(maxsize=1)
+def _local_user() -> str:
+    """Get the name of the current user once.
+
+    Plugins import this module but hardly ever need the name so it is
+    not looked up on import.
+
+    Returns:
+        The name of the user running this process.
+    """
+    return getpass.getuser()
+
+@functools.lru_cache(maxsize=1)
+def _local_host() -> str:
+    """Get the name of this host once (see `_local_user()`).
+
+    Returns:
+        The host name.
+    """
+    return socket.gethostname()
+
+@functools.lru_cache(maxsize=256)
+def _which(name: str) -> Optional[str]:
+    """Locate an executable only once.
+
+    `shutil.which()` stats every directory in `$PATH` on each call.
+
+    Args:
+        name: The name of the executable.
+
+    Returns:
+        The path to the executable or `None` if it could not be found.
+    """
+    return shutil.which(name)
+
+@functools.lru_cache(maxsize=64)
+def _read_template(path: str, mtime_ns: int) -> bytes:
+    """Read a template only once as long as it does not change.
+
+    The same template is often used for several files. `string.Template`
+    compiles its pattern only once anyway so reading the file is what is
+    worth caching.
+
+    Args:
+        path: The path to the template.
+        mtime_ns: The modification time of the template. Only used as
+            part of the key to the cache.
+
+    Returns:
+        The content of the template.
+    """
+    with open(path, 'rb') as file:
+        return file.read()
+
+# `string.Template` compiles its pattern once when the class is created
+# so it can be reused directly without creating a `string.Template` for
+# each file
+_TEMPLATE_PATTERN: re.Pattern = string.Template.pattern
+
+def _render_template(text: str, substitutes: dict[str, str]) -> str:
+    """Substitute `$variables` like `string.Template.safe_substitute()`.
+
+    `$$` becomes `$`, `$name` and `${name}` are replaced if `name` is in
+    `substitutes` and left as they are otherwise.
+
+    Args:
+        text: The text containing the variables.
+        substitutes: A dictionary with the variable names as keys and
+            their substitutes as values.
+
+    Returns:
+        The text with all known variables substituted.
+    """
+    def replace(match: re.Match) -> str:
+        name: Optional[str] = match.group('named') or match.group('braced')
+        if name is not None:
+            return str(substitutes.get(name, match.group()))
+        if match.group('escaped') is not None:
+            return string.Template.delimiter
+        # invalid placeholders, e.g., a lonely "$"
+        return match.group()
+
+    return _TEMPLATE_PATTERN.sub(replace, text)
+
+@functools.lru_cache(maxsize=64)
+def _render_template_file(path: str, mtime_ns: int,
+        substitutes: tuple[tuple[str, str], ...]) -> bytes:
+    """Render a template only once for the same substitutes.
+
+    Args:
+        path: The path to the template.
+        mtime_ns: The modification time of the template (see
+            `_read_template()`).
+        substitutes: The items of the dictionary of substitutes, sorted
+            so equal dictionaries hit the same entry.
+
+    Returns:
+        The rendered template.
+    """
+    return _render_template(_read_template(path, mtime_ns).decode('utf-8'),
+            dict(substitutes)).encode('utf-8')
+
+def _environ(env: Optional[dict[str, str]]) -> Optional[dict[str, str]]:
+    """Add variables to the environment for a subprocess.
+
+    Args:
+        env: The variables to add or `None`.
+
+    Returns:
+        The complete environment or `None` to inherit it unchanged.
+    """
+    if env is None:
+        return None
+    return {**os.environ, **env}
+
 class Fs:
     """Filesystem related functions."""
 
     @staticmethod
-    def backup(path: pathlib.Path, number: int = 0) -> None:
-        """Backup a file by moving it to "FILENAME~" or "FILENAME~NUM~".
+    def _stat(path: Union[str, os.PathLike],
+            follow_symlinks: bool = False) -> Optional[os.stat_result]:
+        """Stat a path once so the result can be reused.
+
+        Args:
+            path: The path to stat.
+            follow_symlinks: Stat the target of a symlink instead of the
+                symlink itself.
+
+        Returns:
+            The stat result or `None` if nothing exists at `path`.
+        """
+        try:
+            return os.stat(path, follow_symlinks=follow_symlinks)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    @staticmethod
+    def _next_backup_number(path: pathlib.Path) -> int:
+        """Find the number for the next backup "FILENAME~NUM~".
 
         Args:
             path: The path to the file to backup.
-            number: The number of the backup. Do not change this.
+
+        Returns:
+            The highest number in use plus one.
 
         Raises:
-            UpsetFsError: If filesystem interaction fails.
+            UpsetFsError: If the directory cannot be listed.
         """
-        if not (path.is_file() or path.is_dir()):
-            return
+        pattern: re.Pattern = _compile_regex(
+                f'{re.escape(path.name)}~([0-9]+)~')
+        number: int = 0
+        try:
+            with os.scandir(path.parent) as entries:
+                for entry in entries:
+                    match: Optional[re.Match] = pattern.fullmatch(entry.name)
+                    if match is not None:
+                        number = max(number, int(match.group(1)))
+        except OSError as error:
+            raise UpsetFsError(
+                    f'could not list "{path.parent}"') from error
+        return number + 1
 
-        suffix: str = f'~{number}~' if number > 0 else '~'
-        backup_path: pathlib.Path = pathlib.Path(str(path) + suffix)
+    @staticmethod
+    def _move_exclusively(path: pathlib.Path, new_path: str) -> None:
+        """Move a file without replacing anything at `new_path`.
 
-        if backup_path.exists():
-            Fs.backup(path, number + 1)
-            return
+        Unlike `os.rename()` `os.link()` never replaces an existing file
+        so operations running in parallel (see `Fs.ensure_many()`)
+        cannot overwrite each other's backups.
 
-        logger.info('creating backup for %s', str(path))
+        Args:
+            path: The file to move.
+            new_path: Where to move the file.
+
+        Raises:
+            FileExistsError: If something exists at `new_path`.
+            OSError: If the file could not be moved.
+        """
         try:
-            path.rename(backup_path)
-        except OSError as error:
-            raise UpsetFsError(f'could not backup "{path}"') from error
+            # a symlink is moved itself, not the file it points to
+            os.link(path, new_path, follow_symlinks=False)
+        except FileExistsError:
+            raise
+        except OSError:
+            # not every filesystem supports hard links
+            if os.path.lexists(new_path):
+                raise FileExistsError(new_path) from None
+            os.rename(path, new_path)
+            return
+        os.unlink(path)
+
+    @staticmethod
+    def forget_ids() -> None:
+        """Forget the cached ids of users and groups.
+
+        Needs to be called after users or groups were added or removed
+        during the run of a plugin (see `_get_uid()`).
+        """
+        _get_uid.cache_clear()
+        _get_gid.cache_clear()
 
     @staticmethod
-    def remove(path: pathlib.Path, backup: bool = True) -> None:
+    def backup(path: pathlib.Path,
+            path_stat: Optional[os.stat_result] = None,
+            symlinks: bool = False) -> bool:
+        """Backup a file by moving it to "FILENAME~" or "FILENAME~NUM~".
+
+        Args:
+            path: The path to the file to backup.
+            path_stat: The result of `Fs._stat(path)` if the caller
+                already has it.
+            symlinks: Move symlinks aside as well instead of leaving
+                them in place.
+
+        Returns:
+            `True` if the file was moved, `False` if there was nothing
+            to backup (nothing at all or a symlink).
+
+        Raises:
+            UpsetFsError: If filesystem interaction fails.
+        """
+        if path_stat is None:
+            path_stat = Fs._stat(path)
+        if path_stat is None or not (stat.S_ISREG(path_stat.st_mode) or
+                stat.S_ISDIR(path_stat.st_mode) or
+                (symlinks and stat.S_ISLNK(path_stat.st_mode))):
+            return False
+
+        logger.info('creating backup for %s', path)
+        backup_path: str = f'{path}~'
+        number: int = 0
+        while True:
+            try:
+                if not stat.S_ISDIR(path_stat.st_mode):
+                    Fs._move_exclusively(path, backup_path)
+                else:
+                    if os.path.lexists(backup_path):
+                        raise FileExistsError(backup_path)
+                    os.rename(path, backup_path)
+                return True
+            except FileExistsError:
+                if number == 0:
+                    # list the directory once and continue after the
+                    # highest number instead of probing "FILENAME~1~",
+                    # "FILENAME~2~", ...
+                    number = Fs._next_backup_number(path)
+                else:
+                    number += 1
+                backup_path = f'{path}~{number}~'
+            except OSError as error:
+                raise UpsetFsError(f'could not backup "{path}"') from error
+
+    @staticmethod
+    def remove(path: pathlib.Path, backup: bool = True,
+            path_stat: Optional[os.stat_result] = None) -> None:
         """Remove the file or move it to "FILENAME(.SUFFIX).bk".
 
         Args:
             path: The path to ensure a file.
             backup: Create a backup (see `Fs.backup()`).
+            path_stat: The result of `Fs._stat(path)` if the caller
+                already has it.
 
         Raises:
             UpsetFsError: If filesystem interaction fails.
         """
-        if backup:
-            Fs.backup(path)
-
-        # the file might have been moved so there is nothing left to be
-        # done
-        if not path.exists():
+        if backup and Fs.backup(path, path_stat):
+            # the file has been moved so there is nothing left to be done
             return
 
-        logger.info('removing path %s', str(path))
+        # just try instead of asking what is there first
         try:
-            if path.is_symlink():
-                path.unlink()
-            elif path.is_dir():
-                path.rmdir()
-            else:
-                path.unlink()
+            try:
+                if path_stat is not None and stat.S_ISDIR(path_stat.st_mode):
+                    os.rmdir(path)
+                else:
+                    # files and symlinks (even to directories)
+                    os.unlink(path)
+            except IsADirectoryError:
+                os.rmdir(path)
+        except FileNotFoundError:
+            return
         except OSError as error:
             raise UpsetFsError(f'could not delete "{path}"') from error
+        logger.info('removed path %s', path)
 
     @staticmethod
     def ensure_file(path: pathlib.Path, template: Template,
@@ -134,47 +521,167 @@ class Fs:
         Raises:
             UpsetFsError: If filesystem interaction fails.
         """
-        logger.info('ensuring file "%s"', str(path))
-        if path.is_dir():
+        logger.info('ensuring file "%s"', path)
+        # follow symlinks like `path.is_file()` would
+        target_stat: Optional[os.stat_result] = Fs._stat(path,
+                follow_symlinks=True)
+        # stat the template at most once as well
+        template_stat: Optional[os.stat_result] = None
+        if target_stat is not None and stat.S_ISDIR(target_stat.st_mode):
             logger.warning('creating file instead of directory %s',
-                    str(path))
-        elif path.is_file():
+                    path)
+        elif target_stat is not None and stat.S_ISREG(target_stat.st_mode):
             if mode == 'asis':
-                logger.debug('target "%s" exists and mode "asis"', str(path))
+                logger.debug('target "%s" exists and mode "asis"', path)
                 return
             if mode != 'force':
                 try:
-                    source_mtime: float = template.file.stat().st_mtime
-                    target_mtime: float = path.stat().st_mtime
+                    template_stat = os.stat(template.file)
                 except OSError as error:
                     raise UpsetFsError(
                             'could not get mtime') from error
-                if target_mtime > source_mtime:
-                    logger.debug('target "%s" newer than source', str(path))
+                if target_stat.st_mtime > template_stat.st_mtime:
+                    logger.debug('target "%s" newer than source', path)
                     return
 
-        # remove or backup the file if it exists
-        Fs.remove(path, backup)
-
+        content: Optional[bytes] = None
         if len(template.substitutes) != 0:
+            # read the template before anything happens to the target
             try:
-                content: str = string.Template(
-                    template.file.read_text(encoding='utf-8')).safe_substitute(
-                            template.substitutes)
+                if template_stat is None:
+                    template_stat = os.stat(template.file)
+                content = _read_template(str(template.file),
+                        template_stat.st_mtime_ns)
             except OSError as error:
                 raise UpsetFsError(
                         f'could not open template "{template.file}"') from error
+            if b'$' in content:
+                try:
+                    content = _render_template_file(str(template.file),
+                            template_stat.st_mtime_ns,
+                            tuple(sorted(template.substitutes.items())))
+                except TypeError:
+                    # substitutes that are not hashable (e.g. lists)
+                    # cannot be cached
+                    content = _render_template(content.decode('utf-8'),
+                            template.substitutes).encode('utf-8')
+
+        if (target_stat is not None and stat.S_ISREG(target_stat.st_mode) and
+                Fs._has_content(path, target_stat, template, content)):
+            # nothing to write, no backup to make
+            logger.debug('"%s" is up to date', path)
+            if permissions not in _KEEP_PERMISSIONS:
+                Fs.ensure_perms(path, permissions, target_stat)
+            return
 
-            logger.info('creating file: %s', str(path))
+        # remove or backup the file if it exists
+        Fs.remove(path, backup)
+
+        # the stat result of the new file for `Fs.ensure_perms()`
+        path_stat: Optional[os.stat_result] = None
+        if content is not None:
+            logger.info('creating file: %s', path)
             try:
-                path.write_text(content, encoding='utf-8')
+                path_stat = Fs._write_file(path, content)
             except OSError as error:
                 raise UpsetFsError(f'could not create file "{path}"') from error
         else:
-            logger.info('copying file "%s" to "%s"', str(template.file),
-                str(path))
-            shutil.copy(str(template.file), str(path))
-        Fs.ensure_perms(path, permissions)
+            logger.info('copying file "%s" to "%s"', template.file, path)
+            try:
+                # `shutil.copy()` keeps the mode of the template which
+                # matters if the permissions leave the mode as is
+                shutil.copy(str(template.file), str(path))
+            except OSError as error:
+                raise UpsetFsError(
+                        f'could not copy template "{template.file}"') from error
+        if permissions not in _KEEP_PERMISSIONS:
+            Fs.ensure_perms(path, permissions, path_stat)
+
+    @staticmethod
+    def _write_file(path: pathlib.Path, content: bytes) -> os.stat_result:
+        """Write `content` to `path` without buffering it again.
+
+        The rendered content is already held in memory so it is written
+        straight to the file descriptor instead of through a buffered
+        file object which would copy it once more. The descriptor is
+        not inherited by child processes (`O_CLOEXEC`). Symlinks are
+        not written through (`O_NOFOLLOW`).
+
+        Args:
+            path: The path of the file to create or truncate.
+            content: The content to write.
+
+        Returns:
+            The stat result of the written file.
+
+        Raises:
+            OSError: If the file cannot be written or is a symlink.
+        """
+        descriptor: int = os.open(path, os.O_WRONLY | os.O_CREAT |
+                os.O_TRUNC | os.O_CLOEXEC | os.O_NOFOLLOW, 0o666)
+        try:
+            view: memoryview = memoryview(content)
+            while view:
+                view = view[os.write(descriptor, view):]
+            # the file is still open so this costs no lookup
+            return os.fstat(descriptor)
+        finally:
+            os.close(descriptor)
+
+    @staticmethod
+    def _has_content(path: pathlib.Path, path_stat: os.stat_result,
+            template: Template, content: Optional[bytes]) -> bool:
+        """Check if a file already looks like `Fs.ensure_file()` would write it.
+
+        Args:
+            path: The path to the existing regular file.
+            path_stat: The result of `os.stat(path)`.
+            template: The template used to create the file.
+            content: The rendered template or `None` if the template
+                would be copied. Copying also copies the mode so it
+                has to match as well.
+
+        Returns:
+            `True` if the file need not be written.
+        """
+        try:
+            if content is None:
+                template_stat: os.stat_result = os.stat(template.file)
+                if (stat.S_IMODE(template_stat.st_mode) !=
+                        stat.S_IMODE(path_stat.st_mode)):
+                    return False
+                content = _read_template(str(template.file),
+                        template_stat.st_mtime_ns)
+            # only read the file if the size matches
+            if path_stat.st_size != len(content):
+                return False
+            # never replace a symlink by writing through it, opening
+            # with `O_NOFOLLOW` fails for symlinks which saves `lstat()`
+            with open(os.open(path, os.O_RDONLY | os.O_NOFOLLOW |
+                    os.O_CLOEXEC), 'rb') as file:
+                return file.read() == content
+        except OSError:
+            # let the caller try to write the file and report errors
+            return False
+
+    @staticmethod
+    def _same_file(path: pathlib.Path, other: pathlib.Path) -> bool:
+        """Check if two paths point to the same existing file.
+
+        `os.path.samefile()` stats both paths anyway so there is no
+        need to check whether they exist beforehand.
+
+        Args:
+            path: The first path.
+            other: The second path.
+
+        Returns:
+            `True` if both paths exist and point to the same file.
+        """
+        try:
+            return os.path.samefile(path, other)
+        except OSError:
+            return False
 
     @staticmethod
     def ensure_link(path: pathlib.Path, target: pathlib.Path,
@@ -194,22 +701,34 @@ class Fs:
         Raises:
             UpsetFsError: If filesystem interaction fails.
         """
-        logger.info('ensuring symlink "%s" to "%s"', str(path), str(target))
-        if path.is_symlink():
-            if (path.exists() and target.exists() and
-                path.resolve().samefile(target)):
-                logging.debug('symlink "%s" already present', str(path))
-                return
-            path.unlink()
-        elif path.exists():
-            Fs.remove(path, backup)
+        logger.info('ensuring symlink "%s" to "%s"', path, target)
+        # one `lstat()` tells whether there is a symlink, something else
+        # or nothing at all
+        path_stat: Optional[os.stat_result] = Fs._stat(path)
+        try:
+            if path_stat is not None and stat.S_ISLNK(path_stat.st_mode):
+                # `os.symlink()` stores `target` verbatim so reading
+                # the link is enough in most cases, resolving it is only
+                # needed if it was created differently
+                if (os.readlink(path) == os.fspath(target) or
+                        Fs._same_file(path, target)):
+                    logger.debug('symlink "%s" already present', path)
+                    return
+                os.unlink(path)
+            elif path_stat is not None:
+                Fs.remove(path, backup, path_stat)
 
-        logger.info('creating symlink "%s"', str(path))
-        path.symlink_to(target)
+            logger.info('creating symlink "%s"', path)
+            os.symlink(target, path)
+        except OSError as error:
+            raise UpsetFsError(
+                    f'could not create symlink "{path}"') from error
 
     @staticmethod
     def ensure_dir(path: pathlib.Path, permissions: str,
-            backup: bool) -> None:
+            backup: bool,
+            path_stat: Optional[os.stat_result] = None,
+            missing: bool = False) -> None:
         """Make sure directory exists.
 
         If the directory does not exist it will be created. If anything
@@ -222,27 +741,45 @@ class Fs:
                 (see `lib.Fs.ensure_perms()`).
             backup: Create a backup (see `Fs.backup()`; default is
                 `True`).
+            path_stat: The result of `Fs._stat(path)` if the caller
+                already has it.
+            missing: The caller already knows that nothing exists at
+                `path` (`Fs._stat(path)` returned `None`).
 
         Raises:
             UpsetFsError: If filesystem interaction fails.
         """
-        logger.info('ensuring directory "%s"', str(path))
-
-        if not path.is_symlink() and path.is_dir():
-            logging.debug('directory "%s" already present', str(path))
-            Fs.ensure_perms(path, permissions)
+        logger.info('ensuring directory "%s"', path)
+
+        if path_stat is None and not missing:
+            path_stat = Fs._stat(path)
+        if path_stat is not None and stat.S_ISDIR(path_stat.st_mode):
+            logger.debug('directory "%s" already present', path)
+            if permissions not in _KEEP_PERMISSIONS:
+                Fs.ensure_perms(path, permissions, path_stat)
             return
 
-        Fs.remove(path, backup)
+        if path_stat is not None:
+            Fs.remove(path, backup, path_stat)
 
-        logger.info('creating directory "%s"', str(path))
+        logger.info('creating directory "%s"', path)
         try:
-            path.mkdir()
+            os.mkdir(path)
+        except FileExistsError as error:
+            # someone else (e.g. another operation of `Fs.ensure_many()`)
+            # was faster, which is fine as long as it is a directory
+            path_stat = Fs._stat(path)
+            if path_stat is None or not stat.S_ISDIR(path_stat.st_mode):
+                raise UpsetFsError(
+                        f'could not create directory "{path}"') from error
         except OSError as error:
             raise UpsetFsError(
                     f'could not create directory "{path}"') from error
+        else:
+            path_stat = None
 
-        Fs.ensure_perms(path, permissions)
+        if permissions not in _KEEP_PERMISSIONS:
+            Fs.ensure_perms(path, permissions, path_stat)
 
     @staticmethod
     def ensure_path(path: pathlib.Path, path_permissions: str,
@@ -278,7 +815,7 @@ class Fs:
         Raises:
             UpsetFsError: If filesystem interaction fails.
         """
-        logger.info('ensuring path "%s"', str(path))
+        logger.info('ensuring path "%s"', path)
 
         permissions: list[str] = path_permissions.split('/')
 
@@ -286,19 +823,24 @@ class Fs:
             raise UpsetFsError(f'permissions "{path_permissions}" do not '
                     f'match path "{path}"')
 
-        i: int = 1
-        for part in path.parts:
-            i += 1
+        # extend the path part by part instead of joining all previous
+        # parts again for every level
+        part_path: str = ''
+        for part, permission in zip(path.parts, permissions):
             if part == '/':
-                permissions.pop(0)
                 continue
+            part_path = f'{part_path}/{part}'
             logger.debug('ensuring part "%s" with permissions "%s"',
-                    '/'.join(path.parts[1:i-1]), permissions[0])
-            Fs.ensure_dir(pathlib.Path(f'/{"/".join(path.parts[1:i-1])}'),
-                    permissions.pop(0), backup)
+                    part_path, permission)
+            # stat every part exactly once and hand the result down to
+            # `Fs.ensure_dir()` and `Fs.ensure_perms()`
+            part_stat: Optional[os.stat_result] = Fs._stat(part_path)
+            Fs.ensure_dir(pathlib.Path(part_path), permission, backup,
+                    part_stat, missing=part_stat is None)
 
     @staticmethod
-    def ensure_perms(path: pathlib.Path, permissions: str) -> None:
+    def ensure_perms(path: pathlib.Path, permissions: str,
+            path_stat: Optional[os.stat_result] = None) -> None:
         """Ensure a file or directory has the given permissions.
 
         For ease of use permissions are indicated using a string::
@@ -325,66 +867,85 @@ class Fs:
         Args:
             path: The path to ensure a file.
             permissions: The permissions to apply.
+            path_stat: The result of `Fs._stat(path)` if the caller
+                already has it.
 
         Raises:
             UpsetFsError: If filesystem interaction fails.
         """
 
-        if permissions in ('-', '-,-,-'):
+        if permissions in _KEEP_PERMISSIONS:
             # leave everything as it is
             return
 
-        if path.is_symlink():
+        if path_stat is None:
+            path_stat = Fs._stat(path)
+        if path_stat is None:
+            raise UpsetFsError(f'could not change permissions on "{path}"')
+
+        if stat.S_ISLNK(path_stat.st_mode):
             logger.warning('cannot change permissions on symlink "%s"',
-                    str(path))
+                    path)
             return
 
+        owner, group, mode, mode_bits = _parse_permissions(permissions)
 
-        parent: pathlib.Path = path.resolve().parent
-        if permissions == '.':
-            owner: str = parent.owner()
-            group: str = parent.group()
-            # stat.S_IMODE will return a decimal representation of the
-            # octal value, e.g. 493 for 0o755
-            # we want a string that can be treated the same way as user
-            # input that would be like "755"
-            # so we use `oct()` which returns a string like:
-            # oct(493) == "0o755"
-            # and remove the "0o" part
-            mode: str = oct(stat.S_IMODE(parent.lstat().st_mode))[2:]
-        else:
-            try:
-                owner,group,mode = permissions.split(',')
-                owner = owner if owner != '.' else parent.owner()
-                group = group if group != '.' else parent.group()
-                mode = mode if mode != '.' else oct(
-                        stat.S_IMODE(parent.lstat().st_mode))[2:]
-            except ValueError as error:
+        # only look at the parent if its permissions are needed
+        parent_stat: Optional[os.stat_result] = None
+        if '.' in (owner, group, mode):
+            parent_stat = Fs._stat(os.path.dirname(os.path.realpath(path)))
+            if parent_stat is None:
                 raise UpsetFsError(
-                        f'malformed permissions "{permissions}"') from error
+                        f'could not get permissions of parent of "{path}"')
 
-        current_mode: str = oct(stat.S_IMODE(path.lstat().st_mode))[2:]
-
-        logging.debug('current owner: %s; should be %s', path.owner(),
-                owner)
-        logging.debug('current group: %s; should be %s', path.group(),
-                group)
-        logging.debug('current mode: %s; should be %s', current_mode,
-                mode)
+        # compare numeric ids with the ones from the stat result instead
+        # of looking up the names of the current owner and group
+        uid: int = -1
+        gid: int = -1
+        try:
+            if owner == '.' and parent_stat is not None:
+                uid = parent_stat.st_uid
+            elif owner != '-':
+                uid = _get_uid(owner)
+            if group == '.' and parent_stat is not None:
+                gid = parent_stat.st_gid
+            elif group != '-':
+                gid = _get_gid(group)
+        except KeyError as error:
+            raise UpsetFsError(
+                    f'unknown user or group in "{permissions}"') from error
+        # `-1` means "leave as is" like for `os.chown()`
+        if mode == '.' and parent_stat is not None:
+            mode_bits = stat.S_IMODE(parent_stat.st_mode)
+
+        current_mode: int = stat.S_IMODE(path_stat.st_mode)
+
+        # modes are compared as integers, only the log shows them in
+        # octal
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('current owner: %s; should be %s',
+                    path_stat.st_uid, uid)
+            logger.debug('current group: %s; should be %s',
+                    path_stat.st_gid, gid)
+            logger.debug('current mode: %o; should be %o', current_mode,
+                    mode_bits)
 
         try:
-            if mode not in (current_mode, '-'):
-                logger.info('changing permissions of file "%s"', str(path))
-                # interpret string as octal
-                path.chmod(int(mode, 8))
-            if owner not in (path.owner(), '-'):
-                logger.info('changing owner of file "%s"', str(path))
-                os.chown(str(path), uid=pwd.getpwnam(owner).pw_uid, gid=-1,
-                        follow_symlinks=False)
-            if group not in (path.group(), '-'):
-                logger.info('changing group of file "%s"', str(path))
-                os.chown(str(path), uid=-1, gid=grp.getgrnam(group).gr_gid,
-                        follow_symlinks=False)
+            if mode_bits not in (current_mode, -1):
+                logger.info('changing permissions of file "%s"', path)
+                os.chmod(path, mode_bits)
+            # `-1` leaves owner or group as they are so both can be
+            # changed with a single call
+            if uid == path_stat.st_uid:
+                uid = -1
+            if gid == path_stat.st_gid:
+                gid = -1
+            if uid != -1:
+                logger.info('changing owner of file "%s"', path)
+            if gid != -1:
+                logger.info('changing group of file "%s"', path)
+            if (uid, gid) != (-1, -1):
+                os.chown(path, uid=uid, gid=gid, follow_symlinks=False)
         except OSError as error:
             raise UpsetFsError(
                     f'could not change permissions on "{path}"') from error
@@ -394,6 +955,9 @@ class Fs:
                        needle: str = '', backup = True) -> None:
         """Ensure a string occcurs in a file.
 
+        The file is searched as UTF-8 encoded bytes so `text`,
+        `insert_at` and `needle` are encoded as UTF-8 as well.
+
         Args:
             path: The path to ensure a file.
             text: The text that must occur in the file.
@@ -408,45 +972,177 @@ class Fs:
         Raises:
             UpsetFsError: If filesystem interaction fails.
         """
+        Fs.ensure_lines_in_file(path, [(text, insert_at, needle)], backup)
+
+    @staticmethod
+    def ensure_lines_in_file(path: pathlib.Path,
+            lines: list[tuple[str, str, str]], backup: bool = True) -> None:
+        """Ensure several strings occur in a file (see `Fs.ensure_in_file()`).
+
+        The file is read and written at most once for all strings. Each
+        string is searched for after the previous ones were inserted.
+
+        If `path` is a symlink the strings are searched for in the file
+        it points to. With `backup` the symlink is moved aside and
+        replaced by a regular file, otherwise the file it points to is
+        changed.
+
+        E.g.::
+
+            Fs.ensure_lines_in_file(path, [
+                ('export A=1', r'\\Z', ''),
+                ('export B=2', r'\\Z', 'export B='),
+            ])
+
+        Args:
+            path: The path to ensure a file.
+            lines: Tuples of `text`, `insert_at` and `needle` as for
+                `Fs.ensure_in_file()`.
+            backup: Create a backup (see `Fs.backup()`; default is
+                `True`) if anything needs to be inserted.
+
+        Raises:
+            UpsetFsError: If filesystem interaction fails.
+        """
+        # work on bytes to avoid decoding and encoding the whole file
         try:
-            if not path.exists():
-                path.touch()
-            haystack: str = path.read_text(encoding='utf-8')
+            with open(path, 'rb') as file:
+                haystack: bytes = file.read()
+        except FileNotFoundError:
+            haystack = b''
+            try:
+                os.close(os.open(path, os.O_WRONLY | os.O_CREAT |
+                        os.O_CLOEXEC, 0o666))
+            except OSError as error:
+                raise UpsetFsError(
+                        f'could not create file "{path}"') from error
         except OSError as error:
             raise UpsetFsError(
                     f'could not read file "{path}"') from error
 
-        logger.info('ensuring "%s" is in "%s"', text.split('\n')[0], str(path))
+        changed: bool = False
+        for text, insert_at, needle in lines:
+            logger.info('ensuring "%s" is in "%s"', Lazy(_first_line, text),
+                    path)
+
+            if needle == '':
+                needle = text
+
+            needle_bytes: bytes = needle.encode('utf-8')
+            if _REGEX_SPECIAL.isdisjoint(needle):
+                # plain text needs no regular expression
+                found: bool = needle_bytes in haystack
+            else:
+                found = _compile_regex(needle_bytes).search(
+                        haystack) is not None
+            if found:
+                logger.debug('text is already in the file')
+                continue
 
-        if needle == '':
-            needle = text
+            logger.info('inserting "%s" into "%s"', Lazy(_first_line, text),
+                    path)
+            if insert_at == r'\Z':
+                # appending does not need to scan the whole file, only
+                # the escapes in `text` need to be expanded like
+                # `re.sub()` would
+                haystack += _INSERT_AT_END.sub(text.encode('utf-8'), b'')
+            else:
+                haystack = _compile_regex(insert_at.encode('utf-8')).sub(
+                        text.encode('utf-8'), haystack)
+            changed = True
 
-        if re.search(needle, haystack):
-            logger.debug('text is already in the file')
+        if not changed:
             return
 
+        write_path: pathlib.Path = path
         if backup:
-            Fs.backup(path)
-
-        logger.info('inserting "%s" into "%s"', text.split('\n')[0], str(path))
-        haystack = re.sub(insert_at, text, haystack)
+            Fs.backup(path, symlinks=True)
+        elif os.path.islink(path):
+            write_path = pathlib.Path(os.path.realpath(path))
 
         try:
-            path.write_text(haystack, encoding='utf-8')
+            Fs._write_file(write_path, haystack)
         except OSError as error:
             raise UpsetFsError(
                     f'could not write file "{path}"') from error
 
+    @staticmethod
+    def ensure_many(
+            operations: list[tuple[Callable[..., None], tuple[Any, ...]]]
+            ) -> None:
+        """Run independent filesystem operations in parallel.
+
+        The operations mostly wait for the filesystem so running them in
+        threads saves time. They must not depend on each other, e.g.,
+        the parts of a path passed to `Fs.ensure_path()` must stay in
+        one operation.
+
+        E.g.::
+
+            Fs.ensure_many([
+                (Fs.ensure_file, (path_a, template, '-')),
+                (Fs.ensure_link, (path_b, target)),
+            ])
+
+        Args:
+            operations: Tuples of a function like `Fs.ensure_file()`
+                and the arguments to call it with.
+
+        Raises:
+            UpsetFsError: If any of the operations fails. All other
+                operations are still run.
+        """
+        max_workers: int = min(32, (os.cpu_count() or 1) * 4)
+        errors: list[Exception] = []
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers) as executor:
+            futures: list[concurrent.futures.Future] = [
+                    executor.submit(function, *arguments)
+                    for function, arguments in operations]
+            for future in futures:
+                try:
+                    future.result()
+                # callers like plugins may raise any `UpsetError` or a
+                # `KeyError` for missing data
+                except (UpsetError, KeyError) as error:
+                    logger.error(str(error))
+                    errors.append(error)
+
+        if len(errors) != 0:
+            raise UpsetFsError(
+                    f'{len(errors)} of {len(operations)} operations '
+                    'failed') from errors[0]
+
 class Sys:
     """Provide interactions with the system."""
 
     @staticmethod
-    def run_command(command_parts: list[str]) -> str:
+    def _is_local(user: str, host: str) -> bool:
+        """Check if `user` and `host` mean the current user on this host.
+
+        Args:
+            user: The user to log in with (`""` for the current user).
+            host: The host to execute the task on (`""` for this host).
+
+        Returns:
+            `True` if no ssh connection is needed.
+        """
+        return host in ('', _local_host()) and user in ('', _local_user())
+
+    @staticmethod
+    def run_command(command_parts: list[str], check: bool = True,
+            env: Optional[dict[str, str]] = None) -> str:
         """Run a command as a subprocess.
 
         Args:
             command_parts: The command with parameters, each in its own
                 string.
+            check: Raise an error if the command returns a non-zero
+                exit code (default). Some commands, e.g., `dpkg-query`
+                use the exit code to signal that something was not
+                found while still producing useful output.
+            env: Variables to add to the environment of the command
+                (instead of prefixing the command in a shell).
 
         Returns:
             Output of the command (without final `"\n"`).
@@ -455,21 +1151,76 @@ class Sys:
             UpsetError: Raised if the remote command fails.
         """
         try:
-            executable_cand: Optional[str] = shutil.which(command_parts[0])
+            executable_cand: Optional[str] = _which(command_parts[0])
             command_parts[0] = executable_cand if executable_cand else \
                     command_parts[0]
             result: subprocess.CompletedProcess = subprocess.run(
-                    command_parts, check=True,
-                    capture_output=True)
-            return (result.stdout.decode().strip() +
-                    result.stderr.decode().strip())
+                    command_parts, check=check,
+                    capture_output=True, text=True, env=_environ(env))
+            output: str = result.stdout.strip()
+            if result.stderr:
+                output += result.stderr.strip()
+            return output
         except subprocess.CalledProcessError as error:
             raise UpsetSysError(
                     f'command {" ".join(command_parts)} returned with '
                     f'"{error.returncode}":\n'
-                    f'{error.output.decode()}\n'
-                    f'{error.stderr.decode()}'
+                    f'{error.output}\n'
+                    f'{error.stderr}'
                     ) from error
+        except OSError as error:
+            raise UpsetSysError(
+                    f'could not run command {" ".join(command_parts)}: '
+                    f'{error}') from error
+
+    @staticmethod
+    def run_command_lines(command_parts: list[str],
+            check: bool = True,
+            env: Optional[dict[str, str]] = None) -> Iterator[str]:
+        """Run a command and yield its output line by line.
+
+        Unlike `Sys.run_command()` the output is not collected first so
+        long listings (e.g. of all installed packages) can be consumed
+        while the command is still running.
+
+        Args:
+            command_parts: The command with parameters, each in its own
+                string.
+            check: Raise an error if the command returns a non-zero
+                exit code (default).
+            env: Variables to add to the environment of the command
+                (see `Sys.run_command()`).
+
+        Yields:
+            Each line of the output (without `"\n"`).
+
+        Raises:
+            UpsetSysError: Raised if the command fails.
+        """
+        executable_cand: Optional[str] = _which(command_parts[0])
+        command_parts[0] = executable_cand if executable_cand else \
+                command_parts[0]
+        # a file cannot fill up and block the command like an unread
+        # pipe could
+        with tempfile.TemporaryFile() as errors:
+            try:
+                process: subprocess.Popen = subprocess.Popen(
+                        command_parts, stdout=subprocess.PIPE,
+                        stderr=errors, text=True, env=_environ(env))
+            except OSError as error:
+                raise UpsetSysError(
+                        f'could not run command {" ".join(command_parts)}: '
+                        f'{error}') from error
+            with process:
+                assert process.stdout is not None
+                for line in process.stdout:
+                    yield line.rstrip('\n')
+                if process.wait() != 0 and check:
+                    errors.seek(0)
+                    raise UpsetSysError(
+                            f'command {" ".join(command_parts)} returned '
+                            f'with "{process.returncode}":\n'
+                            f'{errors.read().decode("utf-8", "replace")}')
 
     @staticmethod
     def build_sudo_command(command_parts: list[str], password: str,
@@ -511,21 +1262,20 @@ class Sys:
             A command that can be passed to a shell via
             `Sys.run_command()`.
         """
-        command: str = ' '.join(command_parts)
         if run_as == 'root':
             run_as = ''
         else:
             run_as = f'-u {run_as}'
-        # base64.b64encode() needs a byte-like argument so the string
-        # is first "encoded"
-        encoded_command: bytes = base64.b64encode(
-                f'echo "{password}" | sudo {run_as} -S --prompt= -- '
-                    f'{command}\n'.encode())
-        # the result is a bytestream so it is "decoded" to a string
-        # but it is still base64-gibberish
+        # base64.b64encode() needs a byte-like argument so the parts
+        # are encoded and joined as bytes right away
+        payload: bytes = b''.join([
+                b'echo "', password.encode(), b'" | sudo ', run_as.encode(),
+                b' -S --prompt= -- ', ' '.join(command_parts).encode(),
+                b'\n'])
+        # the result is base64-gibberish which is plain ASCII
+        encoded_command: str = base64.b64encode(payload).decode('ascii')
         return Sys.build_command(
-                [f'echo {encoded_command.decode()} | base64 -d | '
-                    '$SHELL'],
+                [f'echo {encoded_command} | base64 -d | $SHELL'],
                 user, host, ssh_key)
 
 
@@ -543,20 +1293,31 @@ class Sys:
             host: The host to execute the task on (see
                 `Sys.build_command()` for default behaviour).
             ssh_key: The ssh key or identity to use.
-            sudo: Prepend sudo. For commands as current user on current
-                machine only.
+            sudo: Prepend sudo unless running as root already. For
+                commands as current user on current machine only.
         """
-        if user == '':
-            user = getpass.getuser()
-        if host == '':
-            host = socket.gethostname()
-
-        if host == socket.gethostname() and user == getpass.getuser():
+        if Sys._is_local(user, host):
             if sudo:
+                # plugins are usually run with `sudo` already so another
+                # `sudo` would only go through PAM again for nothing
+                if os.geteuid() == 0:
+                    return list(command_parts)
                 return ['sudo', '--'] + command_parts
+            # parts are joined and interpreted by a shell just like `ssh`
+            # would do remotely, but plain words can be run directly if
+            # they name an executable (builtins like `cd` need bash)
+            if (_which(command_parts[0]) is not None and
+                    all(part != '' and _SHELL_SPECIAL.search(part) is None
+                        for part in command_parts)):
+                return list(command_parts)
             return ['bash', '-c', ' '.join(command_parts)]
 
-        return ['ssh', '-i', str(ssh_key), f'{user}@{host}'] + command_parts
+        if user == '':
+            user = _local_user()
+        if host == '':
+            host = _local_host()
+        return (['ssh', '-i', str(ssh_key)] + _SSH_MULTIPLEXING +
+                [f'{user}@{host}'] + command_parts)
 
     @staticmethod
     def build_scp_command(local_path: pathlib.Path, remote_path: pathlib.Path,
@@ -583,19 +1344,19 @@ class Sys:
         if direction not in ['to', 'from']:
             raise UpsetSysError(f'not a valid option "{direction}"')
 
-        if user == '':
-            user = getpass.getuser()
-        if host == '':
-            host = socket.gethostname()
-
         local: str = str(local_path)
         remote: str = str(remote_path)
 
-        if host == socket.gethostname() and user == getpass.getuser():
+        if Sys._is_local(user, host):
             # use this for debugging
             copy: list[str] = ['cp']
         else:
-            copy = ['scp', '-i', str(ssh_key)]
+            # share the connection with `Sys.build_command()`
+            if user == '':
+                user = _local_user()
+            if host == '':
+                host = _local_host()
+            copy = ['scp', '-i', str(ssh_key)] + _SSH_MULTIPLEXING
             remote = f'{user}@{host}:/{remote}'
 
         if direction == 'to':
@@ -623,8 +1384,18 @@ class Sys:
         Returns:
             The path of the temporary directory.
         """
+        if Sys._is_local(user, host):
+            # no need to start `mktemp` and `mkdir` on this machine
+            try:
+                tmp_dir: pathlib.Path = pathlib.Path(tempfile.mkdtemp())
+                os.mkdir(tmp_dir / 'upset')
+                return tmp_dir
+            except OSError as error:
+                raise UpsetError(
+                        'could not create temporary directory') from error
+
         try:
-            tmp_dir: pathlib.Path = pathlib.Path(Sys.run_command(
+            tmp_dir = pathlib.Path(Sys.run_command(
                 Sys.build_command(['mktemp', '-d'], user, host, ssh_key)))
             Sys.run_command(Sys.build_command(['mkdir', f'{tmp_dir}/upset'],
                 user, host, ssh_key))
@@ -656,11 +1427,13 @@ class Sys:
                 Sys.run_command(
                     Sys.build_sudo_command(['rm', '-r', str(directory)],
                         password, user, host, ssh_key))
+            elif Sys._is_local(user, host):
+                shutil.rmtree(directory)
             else:
                 Sys.run_command(
                     Sys.build_command(['rm', '-r', str(directory)], user,
                         host, ssh_key))
-        except UpsetError as error:
+        except (UpsetError, OSError) as error:
             raise UpsetError(
                     'could not remove temporary directory') from error
 
@@ -682,7 +1455,7 @@ class Sys:
                 This can be changed for unittesting.
         """
         logger.info('ensure "%s" has ssh key for "%s" ("%s")', user, host,
-                str(key_file))
+                key_file)
 
         if key_file.is_file():
             return
@@ -700,9 +1473,8 @@ class Sys:
         print(f'Please enter the password for {user}@{host} to make key files' \
                 'work')
 
-        proc: subprocess.Popen
-        with subprocess.Popen(
-                [f'{shutil.which("ssh")}', f'{user}@{host}',
+        result: subprocess.CompletedProcess = subprocess.run(
+                [f'{_which("ssh")}', f'{user}@{host}',
                     'umask', '077', '&&',
                     'mkdir', '-p', str(authorized_keys_directory), '&&',
                     'chmod', '700', str(authorized_keys_directory), '&&',
@@ -712,14 +1484,9 @@ class Sys:
                             f'echo >> "{authorized_keys}" || exit 1; }}', '&&',
                     'echo', f'"{pub_key_file.read_text(encoding="utf-8")}"',
                     '>>', str(authorized_keys)],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE) as proc:
-            proc.wait()
-            if proc.stdout:
-                logger.debug(proc.stdout.read())
-            if proc.stderr:
-                logger.debug(proc.stderr.read())
+                capture_output=True, check=False)
+        logger.debug(result.stdout)
+        logger.debug(result.stderr)
 
     @staticmethod
     def ensure_ssh_key_absent(user: str, host: str, key_file: pathlib.Path,
@@ -738,7 +1505,7 @@ class Sys:
                 host but keep the key file locally. Use if the same file
                 is used for access on several machines.
         """
-        logger.info('ensure ssh key "%s" is absent', str(key_file))
+        logger.info('ensure ssh key "%s" is absent', key_file)
 
         if not key_file.is_file():
             return
@@ -746,10 +1513,6 @@ class Sys:
         logger.info('removing ssh key for "%s" on "%s"', user, host)
 
         key_file_pub: pathlib.Path = pathlib.Path(str(key_file) + '.pub')
-        key: str = key_file_pub.read_text(encoding='utf-8')
-
-        key = re.sub(r'([]\/$*.^|[])', r'\\\1', key)
-        key = key.split(' ')[1]
 
         Sys.run_command(Sys.build_command([
             'sed', f'\'/{user}@{host}/ D\'', '-i~',
@@ -773,7 +1536,9 @@ class Helper:
         Returns:
         The new name.
         """
-        return '___'.join(file.resolve(strict=False).parts[1:])
+        # `os.path.abspath()` only normalises the string while
+        # `pathlib.Path.resolve()` has to ask the filesystem
+        return '___'.join(os.path.abspath(file).split(os.sep)[1:])
 
     @staticmethod
     def localise_plugin(name: str, paths: list[pathlib.Path]) -> pathlib.Path:
@@ -806,7 +1571,10 @@ class Helper:
             Encoded data.
         """
         try:
-            return base64.b64encode(json.dumps(data).encode()).decode()
+            # `json.dumps()` escapes everything that is not ASCII and
+            # base64 only ever produces ASCII
+            return base64.b64encode(
+                    json.dumps(data).encode('ascii')).decode('ascii')
         except (TypeError, RecursionError, ValueError) as error:
             raise UpsetHelperError(
                     'could not dump and encode data') from error
@@ -823,7 +1591,11 @@ class Helper:
             Decoded JSON object.
         """
         try:
-            return json.loads(base64.b64decode(data).decode())
+            # reject anything that is not base64 instead of silently
+            # dropping it
+            # `json.loads()` detects the encoding of bytes by itself so
+            # there is no need to decode them first
+            return json.loads(base64.b64decode(data, validate=True))
         except (TypeError, RecursionError, ValueError) as error:
             raise UpsetHelperError(
                     'could not decode and load data') from error
@@ -884,8 +1656,14 @@ class Plugin:
     def get_data() -> dict[str, Any]:
         """Get data for the task.
 
+        The data is expected as the first argument encoded by
+        `Helper.encode_data()`.
+
         Returns:
             A dictionary containing the data.
+
+        Raises:
+            UpsetHelperError: If the data could not be decoded.
         """
         return Helper.decode_data(sys.argv[1])
 
@@ -52,41 +52,95 @@ Examples::
 import logging
 import sys
 
+from typing import Any, Callable, Optional
+
 from upset import lib
 
-# create console handler and set level to debug
-logging_handler: logging.StreamHandler = logging.StreamHandler()
-logging_handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(levelname)s %(name)s %(message)s')
-logging_handler.setFormatter(formatter)
-root_logger: logging.Logger = logging.getLogger()
-root_logger.setLevel(logging.DEBUG)
-root_logger.addHandler(logging_handler)
+lib.configure_logging()
 logger: logging.Logger = logging.getLogger(__name__)
 
 class AptPackages(lib.Plugin):
     """Handle installation / removal of packages."""
 
+    def __init__(self) -> None:
+        """Initialise the cache of package states."""
+        super().__init__()
+        # package name -> installed, filled by `installed_packages()`
+        # and cleared whenever `apt-get` might have changed anything
+        self._installed: dict[str, bool] = {}
+        # subtask["ensure"] -> handler, built once instead of comparing
+        # strings for each subtask
+        self._dispatch: dict[str, Callable[[dict[str, Any]], None]] = {
+            'present': lambda subtask: self.ensure_packages(subtask['names']),
+            'absent': lambda subtask: self.ensure_packages_absent(
+                subtask['names']),
+            'update': lambda _: self.apt_do('update'),
+            'upgrade': lambda _: self.apt_do('upgrade'),
+            'clean': lambda _: self.apt_do('clean'),
+            'autoclean': lambda _: self.apt_do('autoclean'),
+            'autoremove': lambda _: self.apt_do('autoremove'),
+        }
+
     def run(self) -> None:
         """Do the main work."""
         for subtask in self.data['variables']['packages']:
-            if subtask['ensure'] == 'present':
-                self.ensure_packages(subtask['names'])
-            elif subtask['ensure'] == 'absent':
-                self.ensure_packages_absent(subtask['names'])
-            elif subtask['ensure'] == 'update':
-                self.apt_do('update')
-            elif subtask['ensure'] == 'upgrade':
-                self.apt_do('upgrade')
-            elif subtask['ensure'] == 'clean':
-                self.apt_do('clean')
-            elif subtask['ensure'] == 'autoclean':
-                self.apt_do('autoclean')
-            elif subtask['ensure'] == 'autoremove':
-                self.apt_do('autoremove')
-            else:
+            handler: Optional[Callable[[dict[str, Any]], None]] = \
+                    self._dispatch.get(subtask['ensure'])
+            if handler is None:
                 raise lib.UpsetError(
                         f'no such subtask "{subtask["ensure"]}"')
+            handler(subtask)
+
+    def installed_packages(self, packages: list[str]) -> set[str]:
+        """Find out which of the packages are installed.
+
+        Asks `dpkg-query` once for all packages instead of calling
+        `dpkg -s` for each package. Answers are remembered until
+        `apt-get` is called so only packages not seen before are looked
+        up.
+
+        Args:
+            packages: The names of the packages.
+
+        Returns:
+            The names of the packages that are installed.
+        """
+        unknown: list[str] = [package for package in packages
+                if package not in self._installed]
+        if len(unknown) != 0:
+            self._installed.update(self._query_installed(unknown))
+        return {package for package in packages if self._installed[package]}
+
+    def _query_installed(self, packages: list[str]) -> dict[str, bool]:
+        """Ask `dpkg-query` which of the packages are installed.
+
+        Names may carry an architecture like `libc6:i386`.
+
+        Args:
+            packages: The names of the packages.
+
+        Returns:
+            The names of the packages and whether they are installed.
+        """
+        # `dpkg-query` exits with "1" if it does not know one of the
+        # packages but still lists the others, its complaints on
+        # `stderr` are of no interest
+        output: str = lib.Sys.run_command(lib.Sys.build_command(
+            ['dpkg-query', '-W',
+                r"-f='${binary:Package}\t${db:Status-Status}\n'"] +
+            packages + ['2>', '/dev/null']), check=False)
+
+        installed: dict[str, bool] = dict.fromkeys(packages, False)
+        for line in output.splitlines():
+            name, _, status = line.partition('\t')
+            if status != 'installed':
+                continue
+            # multi-arch packages are listed as "libc6:amd64" even if
+            # they were asked for without the architecture
+            for candidate in (name, name.partition(':')[0]):
+                if candidate in installed:
+                    installed[candidate] = True
+        return installed
 
     def package_installed(self, package: str) -> bool:
         """Test if the package exists on the system.
@@ -97,11 +151,7 @@ class AptPackages(lib.Plugin):
         Returns:
             `True` if the package exists else `False`.
         """
-        try:
-            lib.Sys.run_command(lib.Sys.build_command(['dpkg', '-s', package]))
-        except lib.UpsetSysError:
-            return False
-        return True
+        return package in self.installed_packages([package])
 
     def ensure_packages(self, packages: list[str]):
         """Ensure packages are present.
@@ -109,19 +159,23 @@ class AptPackages(lib.Plugin):
         Args:
             packages: The names of the packages that need to be present.
         """
-        logger.info('ensuring packages "%s" are present', ', '.join(packages))
+        if len(packages) == 0:
+            return
+        # names may repeat, e.g., after expanding "foreach"
+        packages = list(dict.fromkeys(packages))
 
-        package: str
-        to_install: list[str] = []
-        for package in packages:
-            if self.package_installed(package):
-                continue
-            to_install.append(package)
+        logger.info('ensuring packages "%s" are present',
+                lib.Lazy(', '.join, packages))
+
+        installed: set[str] = self.installed_packages(packages)
+        to_install: list[str] = [package for package in packages
+                if package not in installed]
 
         if len(to_install) == 0:
             return
 
-        logger.info('installing packages "%s"', ', '.join(to_install))
+        logger.info('installing packages "%s"', lib.Lazy(', '.join, to_install))
+        self._installed.clear()
         lib.Sys.run_command(lib.Sys.build_command(
             ['apt-get', '-qq', '-y', 'install'] + to_install,
             sudo=True))
@@ -132,19 +186,23 @@ class AptPackages(lib.Plugin):
         Args:
             packages: The names of the packages that need to be present.
         """
-        logger.info('ensuring packages "%s" are absent', ', '.join(packages))
+        if len(packages) == 0:
+            return
+        # names may repeat, e.g., after expanding "foreach"
+        packages = list(dict.fromkeys(packages))
 
-        package: str
-        to_remove: list[str] = []
-        for package in packages:
-            if not self.package_installed(package):
-                continue
-            to_remove.append(package)
+        logger.info('ensuring packages "%s" are absent',
+                lib.Lazy(', '.join, packages))
+
+        installed: set[str] = self.installed_packages(packages)
+        to_remove: list[str] = [package for package in packages
+                if package in installed]
 
         if len(to_remove) == 0:
             return
 
-        logger.info('removing packages "%s"', ', '.join(to_remove))
+        logger.info('removing packages "%s"', lib.Lazy(', '.join, to_remove))
+        self._installed.clear()
         lib.Sys.run_command(lib.Sys.build_command(
             ['apt-get', '-qq', '-y', 'remove'] + to_remove,
             sudo=True))
@@ -157,6 +215,7 @@ class AptPackages(lib.Plugin):
                 'autoclean', 'autoremove'].
         """
         logger.info('Calling apt-get "%s"', task)
+        self._installed.clear()
 
         lib.Sys.run_command(lib.Sys.build_command(
             ['apt-get', '-qq', '-y', task], sudo=True))
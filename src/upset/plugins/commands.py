@@ -25,33 +25,75 @@ Examples::
 """
 
 import logging
+import shlex
 import sys
 
 from upset import lib
 
-# create console handler and set level to debug
-logging_handler: logging.StreamHandler = logging.StreamHandler()
-logging_handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(levelname)s %(name)s %(message)s')
-logging_handler.setFormatter(formatter)
-root_logger: logging.Logger = logging.getLogger()
-root_logger.setLevel(logging.DEBUG)
-root_logger.addHandler(logging_handler)
+lib.configure_logging()
 logger: logging.Logger = logging.getLogger(__name__)
 
 class Commands(lib.Plugin):
     """Run arbitrary commands in bash."""
 
     def run(self) -> None:
-        """Do the main work."""
+        """Do the main work.
+
+        Consecutive commands with the same `sudo` setting are run
+        together in one shell (see `Commands.ensure_run_batch()`).
+        """
+        batch: list[list[str]] = []
+        batch_sudo: bool = False
         for subtask in self.data['variables']['commands']:
-            if subtask['ensure'] == 'run':
-                self.ensure_run(
-                        subtask['command'],
-                        subtask.get('sudo', False))
-            else:
+            if subtask['ensure'] != 'run':
+                self.ensure_run_batch(batch, batch_sudo)
                 raise lib.UpsetError(
                         f'no such subtask "{subtask["ensure"]}"')
+            sudo: bool = subtask.get('sudo', False)
+            if sudo != batch_sudo:
+                self.ensure_run_batch(batch, batch_sudo)
+                batch = []
+                batch_sudo = sudo
+            batch.append(subtask['command'])
+        self.ensure_run_batch(batch, batch_sudo)
+
+    def ensure_run_batch(self, commands: list[list[str]],
+            sudo: bool = False) -> None:
+        """Run several commands in a single shell.
+
+        The commands are chained with `&&` so the first failing command
+        stops the batch like it would when running them one by one.
+        Each command runs in its own subshell on its own lines so, e.g.,
+        `cd` does not affect the next one and a trailing comment does
+        not swallow the rest of the batch.
+
+        Args:
+            commands: The commands to run, each as list of strings.
+            sudo: Prepend sudo?
+        """
+        if len(commands) == 0:
+            return
+        if len(commands) == 1:
+            self.ensure_run(commands[0], sudo)
+            return
+
+        logger.info('ensuring %s commands are run%s', len(commands),
+                ' as root' if sudo else '')
+
+        if sudo:
+            # `sudo` runs the parts without a shell so they must be
+            # quoted to keep their meaning inside `bash -c`
+            script: str = ' &&\n'.join(
+                    f'(\n{shlex.join(command)}\n)' for command in commands)
+            command_parts: list[str] = ['bash', '-c', script]
+        else:
+            # without `sudo` the parts are interpreted by a shell anyway
+            command_parts = [' &&\n'.join(
+                    f'(\n{" ".join(command)}\n)' for command in commands)]
+
+        output: str = lib.Sys.run_command(
+                lib.Sys.build_command(command_parts, sudo=sudo))
+        print(output)
 
     def ensure_run(self, command: list[str], sudo: bool = False):
         """Run the command.
@@ -61,7 +103,7 @@ class Commands(lib.Plugin):
             sudo: Prepend sudo?
         """
         logger.info('ensuring comand "%s" is run%s',
-                    ''.join(command),
+                    lib.Lazy(''.join, command),
                     ' as root' if sudo else '')
 
         output: str = lib.Sys.run_command(
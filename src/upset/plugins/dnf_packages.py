@@ -62,53 +62,185 @@ Examples::
 import logging
 import sys
 
+from typing import Any, Callable, Optional
+
 from upset import lib
 
-# create console handler and set level to debug
-logging_handler: logging.StreamHandler = logging.StreamHandler()
-logging_handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(levelname)s %(name)s %(message)s')
-logging_handler.setFormatter(formatter)
-root_logger: logging.Logger = logging.getLogger()
-root_logger.setLevel(logging.DEBUG)
-root_logger.addHandler(logging_handler)
+lib.configure_logging()
 logger: logging.Logger = logging.getLogger(__name__)
 
+# subtasks whose names can be handled by a single call to `dnf`
+_MERGE_NAMES: frozenset[str] = frozenset(
+        ('present', 'absent', 'groups_present', 'groups_absent'))
+# subtasks that need not be repeated right after themselves
+_MERGE_REPEATED: frozenset[str] = frozenset(
+        ('update', 'upgrade', 'clean', 'autoremove'))
+
 class DnfPackages(lib.Plugin):
     """Handle installation / removal of packages."""
 
+    def __init__(self) -> None:
+        """Initialise the cache of package states."""
+        super().__init__()
+        # package name -> installed, filled by `installed_packages()`
+        # and cleared whenever `dnf` might have changed anything
+        self._installed: dict[str, bool] = {}
+        # names (and "name.arch") of all installed packages, read once by
+        # `_query_installed()` and forgotten together with `_installed`
+        self._all_installed: Optional[frozenset[str]] = None
+        # subtask["ensure"] -> handler, built once instead of comparing
+        # strings for each subtask
+        self._dispatch: dict[str, Callable[[dict[str, Any]], None]] = {
+            'present': lambda subtask: self.ensure_packages(subtask['names']),
+            'absent': lambda subtask: self.ensure_packages_absent(
+                subtask['names']),
+            'groups_present': lambda subtask: self.ensure_groups(
+                subtask['names']),
+            'groups_absent': lambda subtask: self.ensure_groups_absent(
+                subtask['names']),
+            'update': lambda _: self.dnf_check_update(),
+            'upgrade': lambda _: self.dnf_do('upgrade'),
+            'clean': lambda _: self.dnf_do('clean all'),
+            'autoremove': lambda _: self.dnf_do('autoremove'),
+            'groupupdate': lambda subtask: self.dnf_groupupdate(
+                subtask['parameters']),
+        }
+
     def run(self) -> None:
-        """Do the main work."""
-        self.installed_groups: list[str] = []
-
-        for subtask in self.data['variables']['packages']:
-            if subtask['ensure'] == 'present':
-                self.ensure_packages(subtask['names'])
-            elif subtask['ensure'] == 'absent':
-                self.ensure_packages_absent(subtask['names'])
-            elif subtask['ensure'] == 'groups_present':
-                self.ensure_groups(subtask['names'])
-            elif subtask['ensure'] == 'groups_absent':
-                self.ensure_groups_absent(subtask['names'])
-            elif subtask['ensure'] == 'update':
-                self.dnf_do('check-update')
-            elif subtask['ensure'] == 'upgrade':
-                self.dnf_do('upgrade')
-            elif subtask['ensure'] == 'clean':
-                self.dnf_do('clean all')
-            elif subtask['ensure'] == 'autoremove':
-                self.dnf_do('autoremove')
-            elif subtask['ensure'] == 'groupupdate':
-                self.dnf_groupupdate(subtask['parameters'])
-            else:
+        """Do the main work.
+
+        Consecutive subtasks of the same kind are merged so `dnf` is
+        called once for them (see `DnfPackages.merge_subtasks()`).
+        """
+        # `None` until `group_installed()` lists the groups, a host may
+        # have no groups at all
+        self.installed_groups: Optional[set[str]] = None
+
+        subtasks: list[dict[str, Any]] = self.merge_subtasks(
+                self.data['variables']['packages'])
+        if any(subtask['ensure'] == 'upgrade' for subtask in subtasks):
+            # `dnf upgrade` refreshes the metadata anyway
+            logger.debug('skipping "update" as "upgrade" is queued')
+            subtasks = [subtask for subtask in subtasks
+                    if subtask['ensure'] != 'update']
+
+        for subtask in subtasks:
+            handler: Optional[Callable[[dict[str, Any]], None]] = \
+                    self._dispatch.get(subtask['ensure'])
+            if handler is None:
                 raise lib.UpsetError(
                         f'no such subtask "{subtask["ensure"]}"')
+            handler(subtask)
 
-    def package_installed(self, package: str) -> bool:
-        """Test if the package exists on the system.
+    @staticmethod
+    def merge_subtasks(subtasks: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """Merge consecutive subtasks of the same kind.
+
+        The names of consecutive subtasks that install or remove
+        packages or groups are joined so a single `dnf` transaction
+        handles them. Repeating a subtask without names (e.g. "update")
+        right after itself does nothing so only the first is kept. The
+        order of different subtasks is kept as it may matter.
 
         Args:
-            package: The packages's name.
+            subtasks: The subtasks as given in the task.
+
+        Returns:
+            The merged subtasks (`subtasks` is not changed).
+        """
+        merged: list[dict[str, Any]] = []
+        for subtask in subtasks:
+            if len(merged) != 0 and merged[-1]['ensure'] == subtask['ensure']:
+                if subtask['ensure'] in _MERGE_NAMES:
+                    merged[-1]['names'] = list(dict.fromkeys(
+                            merged[-1]['names'] + subtask['names']))
+                    continue
+                if subtask['ensure'] in _MERGE_REPEATED:
+                    continue
+            merged.append(dict(subtask))
+        return merged
+
+    def installed_packages(self, packages: list[str]) -> set[str]:
+        """Find out which of the packages are installed.
+
+        Asks `rpm` once for all packages instead of once per package.
+        Answers are remembered until `dnf` is called so only packages
+        not seen before are looked up.
+
+        Args:
+            packages: The names of the packages.
+
+        Returns:
+            The names of the packages that are installed.
+        """
+        unknown: list[str] = [package for package in packages
+                if package not in self._installed]
+        if len(unknown) != 0:
+            self._installed.update(self._query_installed(unknown))
+        return {package for package in packages if self._installed[package]}
+
+    def _query_installed(self, packages: list[str]) -> dict[str, bool]:
+        """Ask `rpm` which of the packages are installed.
+
+        Args:
+            packages: The names of the packages.
+
+        Returns:
+            The names of the packages and whether they are installed.
+
+        Raises:
+            UpsetSysError: If `rpm` reports an error.
+        """
+        if self._all_installed is None:
+            # one query of the rpm database answers most lookups
+            self._all_installed = frozenset(lib.Sys.run_command_lines(
+                lib.Sys.build_command(['rpm', '-qa', '--qf',
+                    r"'%{NAME}\n%{NAME}.%{ARCH}\n'"])))
+
+        installed: dict[str, bool] = {}
+        names: list[str] = []
+        for package in packages:
+            if package in self._all_installed:
+                installed[package] = True
+            elif 'https://' in package:
+                installed[package] = self._url_installed(package)
+            else:
+                # may still be installed if given with a version, e.g.
+                # "vim-enhanced-9.0.1"; names that are only provided by
+                # a package are not resolved by `rpm -q` and count as
+                # not installed
+                names.append(package)
+        if len(names) == 0:
+            return installed
+
+        # `rpm -q` handles every name even if some are not installed and
+        # exits with the number of those, it names them in a line each
+        output: str = lib.Sys.run_command(lib.Sys.build_command(
+            ['rpm', '-q'] + names + ['2>&1']), check=False)
+
+        installed.update(dict.fromkeys(names, True))
+        for line in output.splitlines():
+            if line.startswith('error:'):
+                raise lib.UpsetSysError(f'could not query packages: {line}')
+            if line.startswith('package ') and \
+                    line.endswith(' is not installed'):
+                installed[line[8:-17]] = False
+        return installed
+
+    def _forget_installed(self) -> None:
+        """Forget which packages are installed (before calling `dnf`)."""
+        self._installed.clear()
+        self._all_installed = None
+
+    def _url_installed(self, package: str) -> bool:
+        """Test if the package behind a url is installed.
+
+        If a url was given as package name and it resolves `rpm -q`
+        will exit with `0` even if the package is not installed.
+        Instead it returns the package name so this is tested.
+
+        Args:
+            package: The url of the package.
 
         Returns:
             `True` if the package exists else `False`.
@@ -116,18 +248,23 @@ class DnfPackages(lib.Plugin):
         try:
             output: str = lib.Sys.run_command(lib.Sys.build_command(
                 ['rpm', '-q', package, '2>', '/dev/null']))
-            if 'https://' in package:
-                # if a url was given as package name and it resolves
-                # `rpm -q` will exit with `0` even if the package is
-                # not installed
-                # instead it returns the package name
-                # so we test if this is installed
-                lib.Sys.run_command(lib.Sys.build_command(
-                    ['rpm', '-q', output, '2>', '/dev/null']))
+            lib.Sys.run_command(lib.Sys.build_command(
+                ['rpm', '-q', output, '2>', '/dev/null']))
         except lib.UpsetSysError:
             return False
         return True
 
+    def package_installed(self, package: str) -> bool:
+        """Test if the package exists on the system.
+
+        Args:
+            package: The packages's name.
+
+        Returns:
+            `True` if the package exists else `False`.
+        """
+        return package in self.installed_packages([package])
+
     def group_installed(self, group: str) -> bool:
         """Test if the package exists on the system.
 
@@ -137,32 +274,55 @@ class DnfPackages(lib.Plugin):
         Returns:
             `True` if the package exists else `False`.
         """
-        if len(self.installed_groups) == 0:
-            installed: str = lib.Sys.run_command(lib.Sys.build_command([
-                'dnf', 'group', 'list', 'installed']))
-            self.installed_groups = [
-                    item.strip() for item in installed.split('\n')]
+        if self.installed_groups is None:
+            try:
+                # the local metadata is enough to list installed groups
+                self.installed_groups = self._list_installed_groups(['-C'])
+            except lib.UpsetSysError:
+                logger.debug('no metadata cached, listing groups online')
+                self.installed_groups = self._list_installed_groups([])
         return group in self.installed_groups
 
+    def _list_installed_groups(self, options: list[str]) -> set[str]:
+        """List installed groups with `dnf group list installed`.
+
+        Args:
+            options: Additional options for `dnf`.
+
+        Returns:
+            The names of the groups.
+        """
+        # `-q` drops the note about the metadata, strip each line once
+        # and skip empty ones and headers like "Installed Groups:"
+        return {item for item in
+                (line.strip() for line in lib.Sys.run_command_lines(
+                    lib.Sys.build_command(['dnf', '-q'] + options +
+                        ['group', 'list', 'installed'])))
+                if item and not item.endswith(':')}
+
     def ensure_packages(self, packages: list[str]):
         """Ensure packages are present.
 
         Args:
             packages: The names of the packages that need to be present.
         """
-        logger.info('ensuring packages "%s" are present', ', '.join(packages))
+        if len(packages) == 0:
+            return
+        # names may repeat, e.g., after expanding "foreach"
+        packages = list(dict.fromkeys(packages))
 
-        package: str
-        to_install: list[str] = []
-        for package in packages:
-            if self.package_installed(package):
-                continue
-            to_install.append(package)
+        logger.info('ensuring packages "%s" are present',
+                lib.Lazy(', '.join, packages))
+
+        installed: set[str] = self.installed_packages(packages)
+        to_install: list[str] = [package for package in packages
+                if package not in installed]
 
         if len(to_install) == 0:
             return
 
-        logger.info('installing packages "%s"', ', '.join(to_install))
+        logger.info('installing packages "%s"', lib.Lazy(', '.join, to_install))
+        self._forget_installed()
         lib.Sys.run_command(lib.Sys.build_command(
             ['dnf', '-q', '-y', 'install'] + to_install,
             sudo=True))
@@ -173,19 +333,23 @@ class DnfPackages(lib.Plugin):
         Args:
             packages: The names of the packages that need to be present.
         """
-        logger.info('ensuring packages "%s" are absent', ', '.join(packages))
+        if len(packages) == 0:
+            return
+        # names may repeat, e.g., after expanding "foreach"
+        packages = list(dict.fromkeys(packages))
 
-        package: str
-        to_remove: list[str] = []
-        for package in packages:
-            if not self.package_installed(package):
-                continue
-            to_remove.append(package)
+        logger.info('ensuring packages "%s" are absent',
+                lib.Lazy(', '.join, packages))
+
+        installed: set[str] = self.installed_packages(packages)
+        to_remove: list[str] = [package for package in packages
+                if package in installed]
 
         if len(to_remove) == 0:
             return
 
-        logger.info('removing packages "%s"', ', '.join(to_remove))
+        logger.info('removing packages "%s"', lib.Lazy(', '.join, to_remove))
+        self._forget_installed()
         lib.Sys.run_command(lib.Sys.build_command(
             ['dnf', '-q', '-y', 'remove'] + to_remove,
             sudo=True))
@@ -196,7 +360,13 @@ class DnfPackages(lib.Plugin):
         Args:
             groups: The names of the groups that need to be present.
         """
-        logger.info('ensuring groups "%s" are present', ', '.join(groups))
+        if len(groups) == 0:
+            return
+        # names may repeat, e.g., after expanding "foreach"
+        groups = list(dict.fromkeys(groups))
+
+        logger.info('ensuring groups "%s" are present',
+                lib.Lazy(', '.join, groups))
 
         group: str
         to_install: list[str] = []
@@ -208,7 +378,8 @@ class DnfPackages(lib.Plugin):
         if len(to_install) == 0:
             return
 
-        logger.info('installing groups "%s"', ', '.join(to_install))
+        logger.info('installing groups "%s"', lib.Lazy(', '.join, to_install))
+        self._forget_installed()
         lib.Sys.run_command(lib.Sys.build_command(
             ['dnf', '-q', '-y', 'group', 'install'] + to_install,
             sudo=True))
@@ -219,19 +390,26 @@ class DnfPackages(lib.Plugin):
         Args:
             packages: The names of the groups that need to be present.
         """
-        logger.info('ensuring groups "%s" are absent', ', '.join(groups))
+        if len(groups) == 0:
+            return
+        # names may repeat, e.g., after expanding "foreach"
+        groups = list(dict.fromkeys(groups))
+
+        logger.info('ensuring groups "%s" are absent',
+                lib.Lazy(', '.join, groups))
 
         group: str
         to_remove: list[str] = []
         for group in groups:
-            if not self.package_installed(group):
+            if not self.group_installed(group):
                 continue
             to_remove.append(group)
 
         if len(to_remove) == 0:
             return
 
-        logger.info('removing groups "%s"', ', '.join(to_remove))
+        logger.info('removing groups "%s"', lib.Lazy(', '.join, to_remove))
+        self._forget_installed()
         lib.Sys.run_command(lib.Sys.build_command(
             ['dnf', '-q', '-y', 'group', 'remove'] + to_remove,
             sudo=True))
@@ -245,17 +423,32 @@ class DnfPackages(lib.Plugin):
         """
         logger.info('Calling dnf "%s"', task)
 
+        self._forget_installed()
         lib.Sys.run_command(lib.Sys.build_command(
             ['dnf', '-q', '-y', task], sudo=True))
 
+    def dnf_check_update(self) -> None:
+        """Refresh the metadata with `dnf check-update`.
+
+        `dnf check-update` exits with "100" if updates are available
+        which is no error, only "1" is.
+        """
+        logger.info('Calling dnf "check-update"')
+
+        lib.Sys.run_command(lib.Sys.build_command(
+            ['bash', '-c', 'dnf -q -y check-update || [ $? -eq 100 ]'],
+            sudo=True))
+
     def dnf_groupupdate(self, parameters: list[str]) -> None:
         """Do a `dnf groupupdate`.
 
         Args:
             parameters: Parameters to `dnf groupupdate`.
         """
-        logger.info('Calling "dnf groupupdate %s"', ' '.join(parameters))
+        logger.info('Calling "dnf groupupdate %s"',
+                lib.Lazy(' '.join, parameters))
 
+        self._forget_installed()
         lib.Sys.run_command(lib.Sys.build_command(
             ['dnf', '-q', '-y', 'groupupdate'] + parameters, sudo=True))
 
@@ -118,58 +118,167 @@ Examples::
 """
 
 import logging
+import os
 import pathlib
 import sys
 
-from typing import Any
+from typing import Any, Callable, Optional
 from upset import lib
 
-# create console handler and set level to debug
-logging_handler: logging.StreamHandler = logging.StreamHandler()
-logging_handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(levelname)s %(name)s %(message)s')
-logging_handler.setFormatter(formatter)
-root_logger: logging.Logger = logging.getLogger()
-root_logger.setLevel(logging.DEBUG)
-root_logger.addHandler(logging_handler)
+lib.configure_logging()
 logger: logging.Logger = logging.getLogger(__name__)
 
 class Paths(lib.Plugin):
     """Deal with path related tasks."""
 
+    def __init__(self) -> None:
+        """Initialise the subtask handlers."""
+        super().__init__()
+        # subtask["ensure"] -> handler, built once instead of comparing
+        # strings for each subtask
+        self._dispatch: dict[str, Callable[[dict[str, Any]], None]] = {
+            'absent': self.ensure_absent,
+            'file': self.ensure_file,
+            'dir': self.ensure_dir,
+            'path': self.ensure_path,
+            'symlink': self.ensure_symlink,
+            'in_file': self.ensure_in_file,
+        }
+
     def run(self) -> None:
-        """Do the main work."""
+        """Do the main work.
+
+        Consecutive subtasks that do not touch each other's paths are
+        run in parallel (see `lib.Fs.ensure_many()`). Only the paths
+        are compared (see `Paths.independent()`), users and groups are
+        expected to exist already, e.g., created by another plugin.
+
+        A failing subtask does not stop the others in its batch, the
+        error is raised once the whole batch has run. Subtasks after
+        the batch are not run.
+        """
+        batch: list[tuple[Callable[..., None], tuple[Any, ...]]] = []
+        batch_paths: list[str] = []
         for subtask in self.data['variables']['paths']:
-            if not pathlib.Path(subtask['path']).absolute():
+            if not self.subtask_path(subtask).absolute():
                 raise lib.UpsetError('cannot ensure relative path '
                         f'"{subtask["path"]}"')
 
-            if not 'backup' in subtask:
-                subtask['backup'] = True
-
-            if subtask['ensure'] == 'absent':
-                self.ensure_absent(subtask)
-            elif subtask['ensure'] == 'file':
-                self.ensure_file(subtask)
-            elif subtask['ensure'] == 'dir':
-                self.ensure_dir(subtask)
-            elif subtask['ensure'] == 'path':
-                self.ensure_path(subtask)
-            elif subtask['ensure'] == 'symlink':
-                self.ensure_symlink(subtask)
-            elif subtask['ensure'] == 'in_file':
-                self.ensure_in_file(subtask)
-            else:
+            subtask.setdefault('backup', True)
+
+            handler: Optional[Callable[[dict[str, Any]], None]] = \
+                    self._dispatch.get(subtask['ensure'])
+            if handler is None:
+                self.run_batch(batch)
                 raise lib.UpsetError(
                         f'no such subtask "{subtask["ensure"]}"')
 
+            path: str = os.path.normpath(subtask['path'])
+            alone: bool = self.alone(subtask, path)
+            if alone or not self.independent(path, batch_paths):
+                self.run_batch(batch)
+                batch = []
+                batch_paths = []
+            batch.append((handler, (subtask,)))
+            batch_paths.append(path)
+            if alone:
+                self.run_batch(batch)
+                batch = []
+                batch_paths = []
+        self.run_batch(batch)
+
+    @staticmethod
+    def subtask_path(subtask: dict[str, Any],
+            key: str = 'path') -> pathlib.Path:
+        """Get a path of the subtask as `pathlib.Path`.
+
+        The object is built once and kept in the subtask (as `"_path"`
+        for `"path"`) as the checks in `Paths.run()` and the handler
+        both need it.
+
+        Args:
+            subtask: The subtask.
+            key: The key of the path in the subtask.
+
+        Returns:
+            The path.
+        """
+        cache_key: str = f'_{key}'
+        path: Optional[pathlib.Path] = subtask.get(cache_key)
+        if path is None:
+            path = pathlib.Path(subtask[key])
+            subtask[cache_key] = path
+        return path
+
+    @staticmethod
+    def alone(subtask: dict[str, Any], path: str) -> bool:
+        """Check if a subtask must run on its own.
+
+        Symlinks may lead anywhere and `"path"` subtasks change all
+        parents of the path. A path that is a symlink itself or lies
+        below a symlinked directory may resolve to, e.g., a path of
+        another subtask. Such subtasks keep their place in the order
+        given in the task.
+
+        Args:
+            subtask: The subtask.
+            path: The normalised path of the subtask.
+
+        Returns:
+            `True` if the subtask must not run alongside others.
+        """
+        if subtask['ensure'] in ('symlink', 'path') or os.path.islink(path):
+            return True
+        parent: str = os.path.dirname(path)
+        return os.path.realpath(parent) != parent
+
+    @staticmethod
+    def independent(path: str, paths: list[str]) -> bool:
+        """Check if a subtask can run alongside others.
+
+        Subtasks depend on each other if one path contains the other or
+        if they are the same. Only the paths as given are compared (see
+        `Paths.alone()` for subtasks that may reach further).
+
+        Args:
+            path: The normalised path of the subtask.
+            paths: The normalised paths of the other subtasks.
+
+        Returns:
+            `True` if the subtask does not depend on the others.
+        """
+        for other in paths:
+            if (path == other or path.startswith(other.rstrip('/') + '/') or
+                    other.startswith(path.rstrip('/') + '/')):
+                return False
+        return True
+
+    @staticmethod
+    def run_batch(
+            batch: list[tuple[Callable[..., None], tuple[Any, ...]]]
+            ) -> None:
+        """Run independent subtasks (see `Paths.independent()`).
+
+        All subtasks are run even if some of them fail.
+
+        Args:
+            batch: Tuples of a handler and the arguments to call it
+                with.
+        """
+        if len(batch) == 1:
+            # no need for threads
+            handler, arguments = batch[0]
+            handler(*arguments)
+        elif len(batch) > 1:
+            lib.Fs.ensure_many(batch)
+
     def ensure_absent(self, subtask: Any) -> None:
         """Ensure nothing exists at path.
 
         Args:
             subtask: The object in the `Task.variables.paths` list.
         """
-        lib.Fs.remove(pathlib.Path(subtask['path']), subtask['backup'])
+        lib.Fs.remove(self.subtask_path(subtask), subtask['backup'])
 
     def ensure_file(self, subtask: Any) -> None:
         """Ensure a file is present.
@@ -177,34 +286,31 @@ class Paths(lib.Plugin):
         Args:
             subtask: The object in the `Task.variables.paths` list.
         """
-        if 'permissions' in subtask:
-            permissions: str = subtask['permissions']
-        else:
-            permissions = '.,.,600'
+        permissions: str = subtask.get('permissions', '.,.,600')
 
-        if (not 'template' in subtask or
-                not subtask['template'] in self.data['files']):
+        template_name: Optional[str] = subtask.get('template')
+        file_name: Optional[str] = self.data['files'].get(template_name)
+        if file_name is None:
             raise lib.UpsetError(f'no template file for "{subtask["file"]}"'
                     f' @ "{self.data["name"]}"')
 
-        file: pathlib.Path = pathlib.Path(
-                self.data['files'][subtask['template']])
+        file: pathlib.Path = pathlib.Path(file_name)
 
-        if subtask['template'] in self.data['variables']:
-            self.data['for'].update(self.data['variables'][subtask['template']])
+        # subtasks may run in parallel so `self.data['for']` is left as
+        # it is
+        substitutes: dict[str, Any] = dict(self.data['for'])
+        variables: Optional[dict[str, Any]] = self.data['variables'].get(
+                template_name)
+        if variables is not None:
+            substitutes.update(variables)
 
-        template: lib.Template = lib.Template(file, self.data['for'])
-
-        if 'mode' in subtask:
-            mode:str = subtask['mode']
-        else:
-            mode = 'update'
+        template: lib.Template = lib.Template(file, substitutes)
 
         lib.Fs.ensure_file(
-                pathlib.Path(subtask['path']),
+                self.subtask_path(subtask),
                 template,
                 permissions,
-                mode,
+                subtask.get('mode', 'update'),
                 subtask['backup'])
 
     def ensure_dir(self, subtask: Any) -> None:
@@ -213,14 +319,9 @@ class Paths(lib.Plugin):
         Args:
             subtask: The object in the `Task.variables.paths` list.
         """
-        if 'permissions' in subtask:
-            permissions: str = subtask['permissions']
-        else:
-            permissions = '.,.,700'
-
         lib.Fs.ensure_dir(
-                pathlib.Path(subtask['path']),
-                permissions,
+                self.subtask_path(subtask),
+                subtask.get('permissions', '.,.,700'),
                 subtask['backup'])
 
     def ensure_path(self, subtask: Any) -> None:
@@ -231,14 +332,13 @@ class Paths(lib.Plugin):
         Args:
             subtask: The object in the `Task.variables.paths` list.
         """
-        if 'permissions' in subtask:
-            permissions: str = subtask['permissions']
-        else:
+        permissions: Optional[str] = subtask.get('permissions')
+        if permissions is None:
             raise lib.UpsetError('no permissions specified for path '
                     f'"{subtask["path"]}"')
 
         lib.Fs.ensure_path(
-                pathlib.Path(subtask['path']),
+                self.subtask_path(subtask),
                 permissions,
                 subtask['backup'])
 
@@ -249,8 +349,8 @@ class Paths(lib.Plugin):
             subtask: The object in the `Task.variables.paths` list.
         """
         lib.Fs.ensure_link(
-                pathlib.Path(subtask['path']),
-                pathlib.Path(subtask['target']),
+                self.subtask_path(subtask),
+                self.subtask_path(subtask, 'target'),
                 subtask['backup'])
 
     def ensure_in_file(self, subtask: Any) -> None:
@@ -259,15 +359,11 @@ class Paths(lib.Plugin):
         Args:
             subtask: The object in the `Task.variables.paths` list.
         """
-        if not 'insert_at' in subtask or subtask['insert_at'] == '':
-            subtask['insert_at'] = r'\Z'
-        if not 'needle' in subtask:
-            subtask['needle'] = ''
         lib.Fs.ensure_in_file(
-                pathlib.Path(subtask['path']),
+                self.subtask_path(subtask),
                 subtask['text'],
-                subtask['insert_at'],
-                subtask['needle'],
+                subtask.get('insert_at') or r'\Z',
+                subtask.get('needle', ''),
                 subtask['backup'])
 
 if __name__ == '__main__':
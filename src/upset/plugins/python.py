@@ -94,28 +94,64 @@ Examples::
         }
     }
 """
+import concurrent.futures
+import json
 import logging
+import os
 import pathlib
+import re
+import shlex
 import sys
+import threading
 
 from upset import lib
 
-# create console handler and set level to debug
-logging_handler: logging.StreamHandler = logging.StreamHandler()
-logging_handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(levelname)s %(name)s %(message)s')
-logging_handler.setFormatter(formatter)
-root_logger: logging.Logger = logging.getLogger()
-root_logger.setLevel(logging.DEBUG)
-root_logger.addHandler(logging_handler)
+lib.configure_logging()
 logger: logging.Logger = logging.getLogger(__name__)
 
+def _normalise(name: str) -> str:
+    """Normalise a package name so different spellings match.
+
+    pip treats "-", "_" and "." alike and ignores the case.
+
+    Args:
+        name: The name of the package.
+
+    Returns:
+        The normalised name.
+    """
+    return re.sub(r'[-_.]+', '-', name).lower()
+
 class Python(lib.Plugin):
     """Handle creation / deletion of users."""
 
+    def __init__(self) -> None:
+        """Initialise the caches of installed versions and packages."""
+        super().__init__()
+        # pyenv -> installed python versions, shared by the threads of
+        # `Python.ensure_pythons()`
+        self._python_versions: dict[str, frozenset[str]] = {}
+        self._python_versions_lock: threading.Lock = threading.Lock()
+        # (version, pyenv) -> names of packages installed with pip
+        self._pip_installed: dict[tuple[str, str], frozenset[str]] = {}
+        # (version, pyenv, pipx) -> names of packages installed with pipx
+        self._pipx_installed: dict[tuple[str, str, str], frozenset[str]] = {}
+
     def run(self) -> None:
-        """Do the main work."""
+        """Do the main work.
+
+        Consecutive python versions are installed in parallel (see
+        `Python.ensure_pythons()`).
+        """
+        versions: list[tuple[str, str]] = []
         for subtask in self.data['variables']['python']:
+            if subtask['ensure'] == 'python':
+                versions.append(
+                        (subtask['version'], subtask.get('pyenv', '~/.pyenv')))
+                continue
+            self.ensure_pythons(versions)
+            versions = []
+
             if subtask['ensure'] == 'pyenv':
                 self.ensure_pyenv(
                         pathlib.Path(subtask['path']),
@@ -123,9 +159,6 @@ class Python(lib.Plugin):
                                                  '~/.bashrc.d/pyenv')))
             elif subtask['ensure'] == 'pyenv_absent':
                 self.ensure_pyenv_absent(subtask['path'])
-            elif subtask['ensure'] == 'python':
-                self.ensure_python(subtask['version'],
-                                   subtask.get('pyenv', '~/.pyenv'))
             elif subtask['ensure'] == 'python_absent':
                 self.ensure_python_absent(subtask['python'],
                                    subtask.get('pyenv', '~/.pyenv'))
@@ -161,6 +194,7 @@ class Python(lib.Plugin):
             else:
                 raise lib.UpsetError(
                         f'no such subtask "{subtask["ensure"]}"')
+        self.ensure_pythons(versions)
 
     def pyenv_exists(self, path: pathlib.Path) -> bool:
         """Test if pyenv exists on the given path.
@@ -187,14 +221,20 @@ class Python(lib.Plugin):
         if not self.pyenv_exists(path):
             # install
             logger.debug('installing pyenv under "%s"', str(path))
-            output = lib.Sys.run_command(lib.Sys.build_command([
-                'git', 'clone', 'https://github.com/pyenv/pyenv.git',
-                str(path)]))
-            if output != '':
-                print(output)
-            output = lib.Sys.run_command(lib.Sys.build_command([
-                'chown', '-R',
-                f'{path.parent.owner()}:{path.parent.group()}', str(path)]))
+            # clone as the owner of the parent directory so the files
+            # need not be handed over with `chown -R` afterwards, the
+            # history is not needed to run pyenv
+            # clone from within the parent directory, the owner might not
+            # be allowed to read the current working directory of root
+            command: list[str] = ['git', '-C', str(path.parent), 'clone',
+                    '--depth=1', '--single-branch',
+                    'https://github.com/pyenv/pyenv.git', path.name]
+            # only root can switch to another user without a password
+            if (os.geteuid() == 0 and
+                    path.parent.stat().st_uid != os.geteuid()):
+                command = ['sudo', '-u', path.parent.owner(),
+                        '-g', path.parent.group(), '--'] + command
+            output = lib.Sys.run_command(lib.Sys.build_command(command))
             if output != '':
                 print(output)
         else:
@@ -205,26 +245,17 @@ class Python(lib.Plugin):
         # command -v pyenv >/dev/null || export PATH="$PYENV_ROOT/bin:$PATH"
         # eval "$(pyenv init -)"
 
-        lib.Fs.ensure_in_file(
-                path_bashrc,
-                f'export PYENV_ROOT="{path}"',
-                r'\Z',
-                '',
-                False)
-
-        lib.Fs.ensure_in_file(
+        # read and write the file only once for all lines
+        lib.Fs.ensure_lines_in_file(
                 path_bashrc,
-                'command -v pyenv >/dev/null || '
-                    'export PATH="$PYENV_ROOT/bin:$PATH"',
-                r'\Z',
-                'command -v pyenv',
-                False)
-
-        lib.Fs.ensure_in_file(
-                path_bashrc,
-                'eval "$(pyenv init -)"',
-                r'\Z',
-                'pyenv init',
+                [
+                    (f'export PYENV_ROOT="{path}"', r'\Z', ''),
+                    ('command -v pyenv >/dev/null || '
+                        'export PATH="$PYENV_ROOT/bin:$PATH"',
+                        r'\Z',
+                        'command -v pyenv'),
+                    ('eval "$(pyenv init -)"', r'\Z', 'pyenv init'),
+                ],
                 False)
 
     def ensure_pyenv_absent(self, path: pathlib.Path) -> None:
@@ -249,6 +280,33 @@ class Python(lib.Plugin):
         if output != '':
             print(output)
 
+    def _pyenv_command(self, do: str, version: str, pyenv: str,
+            pipx: str) -> tuple[list[str], dict[str, str]]:
+        """Build the command and environment to call pyenv directly.
+
+        Args:
+            do: What to do.
+            version: The python version to use.
+            pyenv: Path to pyenv.
+            pipx: PIPX_HOME.
+
+        Returns:
+            The command and the variables for its environment.
+
+        Raises:
+            UpsetSysError: If there is no pyenv at `pyenv`.
+        """
+        pyenv = os.path.expanduser(pyenv)
+        executable: str = f'{pyenv}/bin/pyenv'
+        if not os.access(executable, os.X_OK):
+            raise lib.UpsetSysError(f'pyenv not found at "{executable}"')
+        env: dict[str, str] = {'PYENV_ROOT': pyenv}
+        if version != '':
+            env['PYENV_VERSION'] = version
+        if pipx != '':
+            env['PIPX_HOME'] = os.path.expanduser(pipx)
+        return [executable] + shlex.split(do), env
+
     def pyenv_do(self, do: str, version: str, pyenv: str, pipx: str) -> str:
         """Do something via pyenv exec.
 
@@ -258,14 +316,29 @@ class Python(lib.Plugin):
             pyenv: Path to the python executable.
             pipx: PIPX_HOME.
         """
-        if version != '':
-            version = f'PYENV_VERSION={version} '
-        if pipx != '':
-            pipx = f'PIPX_HOME=\"{pipx}\" '
-        return lib.Sys.run_command(lib.Sys.build_command([
-            'bash', '-c',
-            f'"PYENV_ROOT=\"{pyenv}\" {version}{pipx}'
-                f'\"{pyenv}/bin/pyenv\" {do}"']))
+        command, env = self._pyenv_command(do, version, pyenv, pipx)
+        # the parts are passed as they are, `lib.Sys.build_command()`
+        # would hand parts like "pkg>=1.0" to a shell
+        return lib.Sys.run_command(command, env=env)
+
+    def pyenv_lines(self, do: str, version: str, pyenv: str,
+            pipx: str) -> list[str]:
+        """Do something via pyenv exec and get the lines of its output.
+
+        Unlike `Python.pyenv_do()` messages on `stderr` do not end up in
+        the output so it can be parsed.
+
+        Args:
+            do: What to do.
+            version: The python version to check.
+            pyenv: Path to the python executable.
+            pipx: PIPX_HOME.
+
+        Returns:
+            The lines of the output.
+        """
+        command, env = self._pyenv_command(do, version, pyenv, pipx)
+        return list(lib.Sys.run_command_lines(command, env=env))
 
     def python_exists(self, version: str, pyenv: str) -> bool:
         """Test if python version exists.
@@ -277,14 +350,13 @@ class Python(lib.Plugin):
         Returns:
             `True` if the version exists else `False`.
         """
-        installed: list[str] = self.pyenv_do(
-            'versions', '', pyenv, '').split('\n')
-        for installed_version in installed:
-            installed_version = installed_version[2:].split(' ')[0]
-            print(installed_version)
-            if version == installed_version:
-                return True
-        return False
+        with self._python_versions_lock:
+            if pyenv not in self._python_versions:
+                # lines look like "* 3.11.4 (set by ...)"
+                self._python_versions[pyenv] = frozenset(
+                        line[2:].split(' ')[0] for line in
+                        self.pyenv_lines('versions', '', pyenv, ''))
+            return version in self._python_versions[pyenv]
 
     def ensure_python(self, version: str, pyenv: str) -> None:
         """Ensure the required version of python exists.
@@ -301,9 +373,48 @@ class Python(lib.Plugin):
 
         logger.info('installing python version "%s"', version)
         output: str = self.pyenv_do(f'install {version}', version, pyenv, '')
+        # forget the versions only now, another thread might have listed
+        # them again while this one was being built
+        with self._python_versions_lock:
+            self._python_versions.pop(pyenv, None)
         if output != '':
             print(output)
 
+    def ensure_pythons(self, versions: list[tuple[str, str]]) -> None:
+        """Ensure several versions of python exist.
+
+        Each version is built in its own directory so two builds may
+        run at the same time, e.g. one downloading while the other
+        compiles. Compiling is CPU-bound and uses all cores already so
+        more builds would only compete for them.
+
+        Args:
+            versions: Tuples of the version and the path to pyenv (see
+                `Python.ensure_python()`).
+
+        Raises:
+            UpsetError: If a version could not be installed. All other
+                versions are still installed.
+        """
+        if len(versions) <= 1:
+            for version, pyenv in versions:
+                self.ensure_python(version, pyenv)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(2, len(versions))) as executor:
+            futures: list[concurrent.futures.Future] = [
+                    executor.submit(self.ensure_python, version, pyenv)
+                    for version, pyenv in versions]
+        errors: list[BaseException] = [error for error in
+                (future.exception() for future in futures)
+                if error is not None]
+        for error in errors:
+            logger.error(str(error))
+        if len(errors) != 0:
+            raise lib.UpsetError(f'{len(errors)} of {len(versions)} python '
+                    'versions could not be installed') from errors[0]
+
     def ensure_python_absent(self, version: str, pyenv: str) -> None:
         """Ensure the version of python does not exists.
 
@@ -318,6 +429,8 @@ class Python(lib.Plugin):
             return
 
         logger.info('removing python version "%s"', version)
+        with self._python_versions_lock:
+            self._python_versions.pop(pyenv, None)
 
         output: str = self.pyenv_do(f'uninstall {version}', version, pyenv, '')
         if output != '':
@@ -337,9 +450,50 @@ class Python(lib.Plugin):
             `True` if package is installed with pipx under version
             else `False`.
         """
-        installed: str = self.pyenv_do('exec pipx list --short', version,
-            pyenv, pipx)
-        return name in installed.split('\n')
+        key: tuple[str, str, str] = (version, pyenv, pipx)
+        if key not in self._pipx_installed:
+            # lines look like "black 23.1.0"
+            self._pipx_installed[key] = frozenset(
+                    _normalise(line.split(' ')[0]) for line in
+                    self.pyenv_lines('exec pipx list --short',
+                        version, pyenv, pipx))
+        return _normalise(name) in self._pipx_installed[key]
+
+    def installed_pip_packages(self, version: str,
+            pyenv: str) -> frozenset[str]:
+        """List the packages installed with pip for a python version.
+
+        The list is asked for once instead of once per package and
+        forgotten when packages are installed or removed.
+
+        Args:
+            version: The python version to check.
+            pyenv: Path to the python executable.
+
+        Returns:
+            The normalised names of the packages (see `_normalise()`).
+
+        Raises:
+            UpsetSysError: If the output of pip could not be read.
+        """
+        key: tuple[str, str] = (version, pyenv)
+        if key not in self._pip_installed:
+            # unlike "--format=freeze" each package is listed by its name
+            # only, not as "name @ url" or "-e ..."
+            try:
+                packages: list[dict[str, str]] = json.loads(''.join(
+                    self.pyenv_lines('exec python -m pip list --format=json',
+                        version, pyenv, '')))
+            except lib.UpsetError:
+                # without pip nothing was installed with it
+                packages = []
+            except ValueError as error:
+                raise lib.UpsetSysError(
+                        'could not read the packages installed with pip'
+                        ) from error
+            self._pip_installed[key] = frozenset(
+                    _normalise(package['name']) for package in packages)
+        return self._pip_installed[key]
 
     def pip_package_exists(self, name: str, version: str, pyenv: str) -> bool:
         """Test if a package was installed for the given python version.
@@ -353,12 +507,10 @@ class Python(lib.Plugin):
             `True` if package is installed under the python version
             else `False`.
         """
-        try:
-            self.pyenv_do(f'exec python -c \"import {name}\" 2>/dev/null',
-                version, pyenv, '')
-        except lib.UpsetError:
-            return False
-        return True
+        # looking up the distribution name avoids starting python for
+        # each package and also finds packages whose module is named
+        # differently (e.g. "scikit-learn" and "sklearn")
+        return _normalise(name) in self.installed_pip_packages(version, pyenv)
 
     def ensure_pip(self, version: str, pyenv: str) -> None:
         """Ensure pip is installed.
@@ -373,24 +525,27 @@ class Python(lib.Plugin):
         if self.pip_package_exists('pip', version, pyenv):
             logger.info('pip already exists under "%s"', version)
         logger.debug('installing pip under "%s"', version)
+        self._pip_installed.clear()
         self.pyenv_do('exec python -m ensurepip --upgrade',
             version, pyenv, '')
 
-    def package_do(self, packagemanager: str, name: str, action: str,
+    def package_do(self, packagemanager: str, names: list[str], action: str,
                    version: str, pyenv: str, pipx: str) -> None:
-        """Ensure pip is installed.
+        """Install or remove packages with a single call.
 
         Args:
             packagemanager: The packagemanager (pip, pipx, pipenv).
-            name: The name of the package.
+            names: The names of the packages.
             action: The action (install, remove)
             version: The python version the pipx package should run
                 under.
             pyenv: Path to the python executable.
             pipx: PIPX_HOME.
         """
-        self.pyenv_do(f'exec python -m {packagemanager} {action} {name}',
-            version, pyenv, pipx)
+        self._pip_installed.clear()
+        self._pipx_installed.clear()
+        self.pyenv_do(f'exec python -m {packagemanager} {action} '
+            f'{" ".join(names)}', version, pyenv, pipx)
 
     def ensure_pipx(self, path: pathlib.Path,
                     path_bashrc: pathlib.Path, version: str,
@@ -410,7 +565,8 @@ class Python(lib.Plugin):
         if not self.pip_package_exists('pipx', version, pyenv):
             # install
             logger.debug('installing pipx under "%s"', str(path))
-            self.package_do('pip', 'pipx', 'install', version, pyenv, str(path))
+            self.package_do('pip', ['pipx'], 'install', version, pyenv,
+                str(path))
             self.pyenv_do('exec python -m pipx ensurepath', version, pyenv,
                 str(path))
         else:
@@ -443,7 +599,8 @@ class Python(lib.Plugin):
             return
 
         logger.info('removing pipx from "%s"', version)
-        self.package_do('pip', 'pipx', 'uninstall', version, pyenv, str(path))
+        self.package_do('pip', ['pipx'], 'uninstall', version, pyenv,
+            str(path))
 
     def ensure_packages(self, packagemanager: str, names: list[str],
                         version: str, pyenv: str, pipx: str,
@@ -463,8 +620,8 @@ class Python(lib.Plugin):
         to_install: list[str] = []
 
         for name in names:
-            if packagemanager == 'pip' and self.pip_package_exists(
-                    name, version, pyenv):
+            if packagemanager == 'pip' and _normalise(name) in \
+                    self.installed_pip_packages(version, pyenv):
                 logger.info('"%s" (%s) already exists under "%s"',
                     packagemanager, name, version)
                 continue
@@ -483,10 +640,20 @@ class Python(lib.Plugin):
         else:
             action = f'install {options}'
 
+        if len(to_install) == 0:
+            return
+
         logger.debug('installing %s packages "%s" under "%s"',
             packagemanager, ', '.join(to_install), version)
+        if packagemanager == 'pip':
+            # pip resolves all packages at once, starting python and
+            # pip only once
+            self.package_do(packagemanager, to_install, action, version,
+                pyenv, pipx)
+            return
+        # pipx creates a virtual environment for each package
         for name in to_install:
-            self.package_do(packagemanager, name, action, version,
+            self.package_do(packagemanager, [name], action, version,
                 pyenv, pipx)
 
     def ensure_packages_absent(self, packagemanager: str, names: list[str],
@@ -506,8 +673,8 @@ class Python(lib.Plugin):
         to_remove: list[str] = []
 
         for name in names:
-            if packagemanager == 'pip' and not self.pip_package_exists(
-                    name, version, pyenv):
+            if packagemanager == 'pip' and _normalise(name) not in \
+                    self.installed_pip_packages(version, pyenv):
                 logger.info('"%s" (%s) already does not exist under "%s"',
                     packagemanager, name, version)
                 continue
@@ -521,11 +688,19 @@ class Python(lib.Plugin):
                     f'unknown packagemanager "{packagemanager}"')
             to_remove.append(name)
 
+        if len(to_remove) == 0:
+            return
+
         logger.debug('removing %s packages "%s" from "%s"',
             packagemanager, ', '.join(to_remove), version)
+        if packagemanager == 'pip':
+            self.package_do(packagemanager, to_remove, 'uninstall -y',
+                version, pyenv, pipx)
+            return
+        # `pipx uninstall` takes a single package
         for name in to_remove:
-            self.package_do(packagemanager, name, 'uninstall', version, pyenv,
-                pipx)
+            self.package_do(packagemanager, [name], 'uninstall', version,
+                pyenv, pipx)
 
 
 if __name__ == '__main__':
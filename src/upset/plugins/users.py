@@ -79,21 +79,24 @@ import logging
 import pwd
 import sys
 
+from typing import Optional
+
 from upset import lib
 
-# create console handler and set level to debug
-logging_handler: logging.StreamHandler = logging.StreamHandler()
-logging_handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(levelname)s %(name)s %(message)s')
-logging_handler.setFormatter(formatter)
-root_logger: logging.Logger = logging.getLogger()
-root_logger.setLevel(logging.DEBUG)
-root_logger.addHandler(logging_handler)
+lib.configure_logging()
 logger: logging.Logger = logging.getLogger(__name__)
 
 class Users(lib.Plugin):
     """Handle creation / deletion of users."""
 
+    def __init__(self) -> None:
+        """Initialise the caches of users and groups."""
+        super().__init__()
+        # name -> entry, filled on first use and dropped whenever users,
+        # groups or memberships are changed here
+        self._users: Optional[dict[str, pwd.struct_passwd]] = None
+        self._groups: Optional[dict[str, grp.struct_group]] = None
+
     def run(self) -> None:
         """Do the main work."""
         for subtask in self.data['variables']['users']:
@@ -118,6 +121,34 @@ class Users(lib.Plugin):
                 raise lib.UpsetError(
                         f'no such subtask "{subtask["ensure"]}"')
 
+    def _get_users(self) -> dict[str, pwd.struct_passwd]:
+        """Get all users by their names.
+
+        Returns:
+            The user entries by name.
+        """
+        if self._users is None:
+            # listing all users may have to ask NSS (think LDAP) so it
+            # is done once instead of for each check
+            self._users = {user.pw_name: user for user in pwd.getpwall()}
+        return self._users
+
+    def _get_groups(self) -> dict[str, grp.struct_group]:
+        """Get all groups by their names.
+
+        Returns:
+            The group entries by name.
+        """
+        if self._groups is None:
+            self._groups = {group.gr_name: group for group in grp.getgrall()}
+        return self._groups
+
+    def _forget_users(self) -> None:
+        """Forget users and groups after changing them."""
+        self._users = None
+        self._groups = None
+        lib.Fs.forget_ids()
+
     def user_exists(self, name: str) -> bool:
         """Test if the user exists on the system.
 
@@ -127,8 +158,7 @@ class Users(lib.Plugin):
         Returns:
             `True` if the user exists else `False`.
         """
-        usernames: list[str] = [x[0] for x in pwd.getpwall()]
-        return name in usernames
+        return name in self._get_users()
 
     def group_exists(self, name: str) -> bool:
         """Test if the group exists on the system.
@@ -139,8 +169,7 @@ class Users(lib.Plugin):
         Returns:
             `True` if the group exists else `False`.
         """
-        groupnames: list[str] = [x[0] for x in grp.getgrall()]
-        return name in groupnames
+        return name in self._get_groups()
 
     def user_in_group(self, name: str, group: str) -> bool:
         """Test wether a user is in a group.
@@ -152,12 +181,12 @@ class Users(lib.Plugin):
         Returns:
             `True` if the `name` is in `group` else `False`.
         """
-        if not self.user_exists(name):
+        user: Optional[pwd.struct_passwd] = self._get_users().get(name)
+        if user is None:
             raise lib.UpsetError(f'no such user "{name}"')
-        if not self.group_exists(group):
+        group_info: Optional[grp.struct_group] = self._get_groups().get(group)
+        if group_info is None:
             raise lib.UpsetError(f'no such group "{group}"')
-        group_info: grp.struct_group = grp.getgrnam(group)
-        user = pwd.getpwnam(name)
         # see if the group is the primary group -> check user object
         # see if it is a secondary group -> check group-members
         return group_info.gr_gid == user.pw_gid or name in group_info.gr_mem
@@ -201,6 +230,7 @@ class Users(lib.Plugin):
         logger.info('creating user "%s"', name)
 
         lib.Sys.run_command(lib.Sys.build_command(command, sudo=True))
+        self._forget_users()
 
         if password != '':
             logger.info('setting password for user "%s"', name)
@@ -223,6 +253,7 @@ class Users(lib.Plugin):
 
         lib.Sys.run_command(lib.Sys.build_command(['deluser', name],
             sudo=True))
+        self._forget_users()
 
     def ensure_group(self, name: str, gid: str = ''):
         """Create a group.
@@ -248,6 +279,7 @@ class Users(lib.Plugin):
         logger.info('creating group "%s"', name)
 
         lib.Sys.run_command(lib.Sys.build_command(command, sudo=True))
+        self._forget_users()
 
     def ensure_group_absent(self, name: str) -> None:
         """Ensure a group is absent.
@@ -264,6 +296,7 @@ class Users(lib.Plugin):
 
         lib.Sys.run_command(lib.Sys.build_command(['delgroup', name],
             sudo=True))
+        self._forget_users()
 
     def ensure_in_group(self, name: str, groups: str) -> None:
         """Ensure user is in the given group.
@@ -282,6 +315,8 @@ class Users(lib.Plugin):
 
             lib.Sys.run_command(lib.Sys.build_command(
                 ['adduser', name, group], sudo=True))
+            # only the members of the group changed
+            self._groups = None
 
     def ensure_not_in_group(self, name, groups):
         """Ensure user is not in the given group.
@@ -300,6 +335,8 @@ class Users(lib.Plugin):
 
             lib.Sys.run_command(lib.Sys.build_command(
                 ['deluser', name, group], sudo=True))
+            # only the members of the group changed
+            self._groups = None
 
 if __name__ == '__main__':
     users: Users = Users()
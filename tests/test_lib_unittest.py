@@ -6,9 +6,11 @@ import logging.config
 import os
 import pathlib
 import socket
+import sys
 import time
 import unittest
 
+from unittest import mock
 from upset import lib
 
 # create console handler and set level to debug
@@ -72,6 +74,15 @@ class TestLibFs(unittest.TestCase):
         self.assertTrue(pathlib.Path(self._base_dir / 'b~').exists())
         self.assertTrue(pathlib.Path(self._base_dir / 'b~1~').exists())
 
+    def test_backup_count_up_highest(self) -> None:
+        """Create a backup numbered after the highest backup."""
+        for name in ('b', 'b~', 'b~1~', 'b~3~', 'bb~7~'):
+            pathlib.Path(self._base_dir / name).touch()
+        lib.Fs.backup(self._base_dir / 'b')
+        self.assertFalse(pathlib.Path(self._base_dir / 'b').exists())
+        self.assertFalse(pathlib.Path(self._base_dir / 'b~2~').exists())
+        self.assertTrue(pathlib.Path(self._base_dir / 'b~4~').exists())
+
     def test_backup_no_file(self) -> None:
         """Do nothing as no file exists."""
         lib.Fs.backup(self._base_dir / 'c')
@@ -142,6 +153,33 @@ class TestLibFs(unittest.TestCase):
                 pathlib.Path(self._base_dir / 'a').read_text(encoding='utf-8'),
                 'Greetings, oh admin!')
 
+    def test_ensure_file_placeholders(self) -> None:
+        """Substitute only known placeholders."""
+        pathlib.Path(self._base_dir / 't').write_text(
+                '${greeting}$$ $unknown ${user}s $', encoding='utf-8')
+        lib.Fs.ensure_file(pathlib.Path(self._base_dir / 'a'),
+                lib.Template(file=pathlib.Path(self._base_dir / 't'),
+                    substitutes = {'user': 'admin', 'greeting': 'Greetings'}),
+                '-',  mode='force', backup=False)
+        self.assertEqual(
+                pathlib.Path(self._base_dir / 'a').read_text(encoding='utf-8'),
+                'Greetings$ $unknown admins $')
+
+    def test_ensure_file_unchanged(self) -> None:
+        """Do not rewrite a file that already has the content."""
+        pathlib.Path(self._base_dir / 't').write_text('$greeting!',
+                encoding='utf-8')
+        pathlib.Path(self._base_dir / 'a').write_text('Greetings!',
+                encoding='utf-8')
+        lib.Fs.ensure_file(pathlib.Path(self._base_dir / 'a'),
+                lib.Template(file=pathlib.Path(self._base_dir / 't'),
+                    substitutes = {'greeting': 'Greetings'}),
+                '-',  mode='force', backup=True)
+        self.assertFalse(pathlib.Path(self._base_dir / 'a~').exists())
+        self.assertEqual(
+                pathlib.Path(self._base_dir / 'a').read_text(encoding='utf-8'),
+                'Greetings!')
+
     def test_ensure_file_update(self) -> None:
         """Ensure file exists and is updated."""
         pathlib.Path(self._base_dir / 'a').write_text('Hello!',
@@ -244,6 +282,52 @@ class TestLibFs(unittest.TestCase):
         self.assertTrue(pathlib.Path(self._base_dir / 'a').is_dir())
         self.assertTrue(pathlib.Path(self._base_dir / 'a~').exists())
 
+    def test_ensure_many(self) -> None:
+        """Ensure several directories exist."""
+        pathlib.Path(self._base_dir / 'a').touch()
+        lib.Fs.ensure_many([
+            (lib.Fs.ensure_dir, (self._base_dir / 'a', '-', True)),
+            (lib.Fs.ensure_dir, (self._base_dir / 'b', '-', True)),
+        ])
+        self.assertTrue(pathlib.Path(self._base_dir / 'a').is_dir())
+        self.assertTrue(pathlib.Path(self._base_dir / 'a~').exists())
+        self.assertTrue(pathlib.Path(self._base_dir / 'b').is_dir())
+        with self.assertRaises(lib.UpsetFsError):
+            lib.Fs.ensure_many([
+                (lib.Fs.ensure_dir, (self._base_dir / 'c', '-', True)),
+                (lib.Fs.ensure_dir, (self._base_dir / 'd' / 'e', '-', True)),
+            ])
+        self.assertTrue(pathlib.Path(self._base_dir / 'c').is_dir())
+
+    def test_ensure_many_mixed_errors(self) -> None:
+        """Run all operations even if some raise other errors."""
+        def fail_upset() -> None:
+            raise lib.UpsetError('fail')
+
+        def fail_key() -> None:
+            raise KeyError('template')
+
+        with self.assertRaises(lib.UpsetFsError):
+            lib.Fs.ensure_many([
+                (fail_upset, ()),
+                (fail_key, ()),
+                (lib.Fs.ensure_dir, (self._base_dir / 'f', '-', True)),
+            ])
+        self.assertTrue(pathlib.Path(self._base_dir / 'f').is_dir())
+
+    def test_ensure_perms(self) -> None:
+        """Ensure permissions by user and group name."""
+        pathlib.Path(self._base_dir / 'a').touch()
+        user: str = getpass.getuser()
+        lib.Fs.ensure_perms(pathlib.Path(self._base_dir / 'a'),
+                f'{user},-,600')
+        self.assertEqual(
+                pathlib.Path(self._base_dir / 'a').stat().st_mode & 0o777,
+                0o600)
+        with self.assertRaises(lib.UpsetFsError):
+            lib.Fs.ensure_perms(pathlib.Path(self._base_dir / 'a'),
+                    'no-such-user-upset,-,600')
+
     def test_ensure_in_file_append(self) -> None:
         """Ensure text occurs in a file."""
         pathlib.Path(self._base_dir / 'a').write_text('a',
@@ -277,6 +361,51 @@ class TestLibFs(unittest.TestCase):
                 'a\nc="d"\nc')
         self.assertTrue(pathlib.Path(self._base_dir / 'a~').exists())
 
+    def test_ensure_in_file_twice(self) -> None:
+        """Insert the text only once when called repeatedly."""
+        pathlib.Path(self._base_dir / 'a').write_text('a',
+                encoding='utf-8')
+        for _ in range(2):
+            lib.Fs.ensure_in_file(pathlib.Path(self._base_dir / 'a'),
+                    r'\nc="b"', backup = False)
+        self.assertEqual(
+                pathlib.Path(self._base_dir / 'a').read_text(encoding='utf-8'),
+                'a\nc="b"')
+
+    def test_ensure_lines_in_file(self) -> None:
+        """Ensure several lines are in a file, one is there already."""
+        path: pathlib.Path = pathlib.Path(self._base_dir / 'a')
+        path.write_text('a\n', encoding='utf-8')
+        lib.Fs.ensure_lines_in_file(path, [
+                ('a\n', r'\Z', ''),
+                ('b\n', r'\Z', ''),
+                ('c\n', '^', 'c'),
+                ], False)
+        self.assertEqual(path.read_text(encoding='utf-8'), 'c\na\nb\n')
+        self.assertFalse(pathlib.Path(self._base_dir / 'a~').exists())
+
+    def test_ensure_in_file_symlink_backup(self) -> None:
+        """Replace a symlink by a file and keep the link as backup."""
+        target: pathlib.Path = pathlib.Path(self._base_dir / 't')
+        target.write_text('a\n', encoding='utf-8')
+        link: pathlib.Path = pathlib.Path(self._base_dir / 'l')
+        link.symlink_to(target.name)
+        lib.Fs.ensure_lines_in_file(link, [('b\n', r'\Z', '')], True)
+        self.assertEqual(target.read_text(encoding='utf-8'), 'a\n')
+        self.assertFalse(link.is_symlink())
+        self.assertEqual(link.read_text(encoding='utf-8'), 'a\nb\n')
+        self.assertTrue(pathlib.Path(self._base_dir / 'l~').is_symlink())
+
+    def test_ensure_in_file_symlink_no_backup(self) -> None:
+        """Change the file a symlink points to."""
+        target: pathlib.Path = pathlib.Path(self._base_dir / 't')
+        target.write_text('a\n', encoding='utf-8')
+        link: pathlib.Path = pathlib.Path(self._base_dir / 'l')
+        link.symlink_to(target.name)
+        lib.Fs.ensure_lines_in_file(link, [('b\n', r'\Z', '')], False)
+        self.assertEqual(target.read_text(encoding='utf-8'), 'a\nb\n')
+        self.assertTrue(link.is_symlink())
+
     def test_ensure_in_file_no_file_append(self) -> None:
         """Ensure text occurs in a non-existent file."""
         lib.Fs.ensure_in_file(pathlib.Path(self._base_dir / 'a'),
@@ -326,10 +455,49 @@ class TestLibSys(unittest.TestCase):
                 lib.Sys.run_command(['bash', '-c', 'echo Hello']),
                 'Hello')
 
+    def test_run_command_env(self) -> None:
+        """Run command with additional environment variables."""
+        self.assertEqual(
+                lib.Sys.run_command(['bash', '-c', 'echo $UPSET_TEST'],
+                    env={'UPSET_TEST': 'Hello'}),
+                'Hello')
+
     def test_run_command_fail(self) -> None:
         """Fail running a command."""
         with self.assertRaises(lib.UpsetSysError):
             lib.Sys.run_command(['cp', '--fail'])
+        with self.assertRaises(lib.UpsetSysError):
+            lib.Sys.run_command(['/nonexistent/upset-test'])
+
+    def test_run_command_lines(self) -> None:
+        """Run command and read its output line by line."""
+        self.assertEqual(
+                list(lib.Sys.run_command_lines(
+                    ['bash', '-c', 'echo Hello; echo World'])),
+                ['Hello', 'World'])
+        with self.assertRaises(lib.UpsetSysError):
+            list(lib.Sys.run_command_lines(['cp', '--fail']))
+        with self.assertRaises(lib.UpsetSysError):
+            list(lib.Sys.run_command_lines(['/nonexistent/upset-test']))
+
+    def test_build_command(self) -> None:
+        """Build local commands with a shell only if needed."""
+        self.assertEqual(lib.Sys.build_command(['echo', 'Hello']),
+                ['echo', 'Hello'])
+        self.assertEqual(lib.Sys.build_command(['echo', '"Hello"']),
+                ['bash', '-c', 'echo "Hello"'])
+        self.assertEqual(lib.Sys.build_command(['ls', '&&', 'ls']),
+                ['bash', '-c', 'ls && ls'])
+        self.assertEqual(lib.Sys.build_command(['cd', 'tmp']),
+                ['bash', '-c', 'cd tmp'])
+        with mock.patch.object(os, 'geteuid', return_value=0):
+            self.assertEqual(
+                    lib.Sys.build_command(['bash', '-c', 'ls'], sudo=True),
+                    ['bash', '-c', 'ls'])
+        with mock.patch.object(os, 'geteuid', return_value=1000):
+            self.assertEqual(
+                    lib.Sys.build_command(['bash', '-c', 'ls'], sudo=True),
+                    ['sudo', '--', 'bash', '-c', 'ls'])
 
     def test_build_command_run(self) -> None:
         """Run command."""
@@ -364,7 +532,9 @@ class TestLibSys(unittest.TestCase):
         self.assertEqual(
                 lib.Sys.build_scp_command(file_a, file_b, 'to', 'test', 'host',
                     ssh_key=pathlib.Path('ssh_key')),
-                ['scp', '-i', 'ssh_key', '-p', 'a',
+                ['scp', '-i', 'ssh_key', '-o', 'ControlMaster=auto',
+                    '-o', 'ControlPath=~/.ssh/upset-%C',
+                    '-o', 'ControlPersist=60s', '-p', 'a',
                     'test@host:/b'])
 
     def test_build_scp_command_from(self) -> None:
@@ -374,7 +544,9 @@ class TestLibSys(unittest.TestCase):
         self.assertEqual(
                 lib.Sys.build_scp_command(file_a, file_b, 'from', 'test',
                     'host', ssh_key=pathlib.Path('ssh_key')),
-                ['scp', '-i', 'ssh_key', '-p', 'test@host:/b',
+                ['scp', '-i', 'ssh_key', '-o', 'ControlMaster=auto',
+                    '-o', 'ControlPath=~/.ssh/upset-%C',
+                    '-o', 'ControlPersist=60s', '-p', 'test@host:/b',
                     'a'])
 
     def test_build_scp_command_run(self) -> None:
@@ -480,5 +652,25 @@ class TestLibHelper(unittest.TestCase):
                 lib.Helper.decode_data('eyJncmVldGluZyI6ICJoZWxsbyJ9'),
                 {'greeting': 'hello'})
 
+class TestLibLazy(unittest.TestCase):
+    """Test Lazy from lib."""
+
+    def test_lazy(self) -> None:
+        """Build the string only when needed."""
+        parts: list[str] = ['a']
+        lazy: lib.Lazy = lib.Lazy(', '.join, parts)
+        # the string does not exist yet so it sees the change
+        parts.append('b')
+        self.assertEqual(str(lazy), 'a, b')
+
+class TestLibPlugin(unittest.TestCase):
+    """Test Plugin from lib."""
+
+    def test_get_data(self) -> None:
+        """Get data from the arguments."""
+        with mock.patch.object(sys, 'argv',
+                ['a.py', 'eyJncmVldGluZyI6ICJoZWxsbyJ9']):
+            self.assertEqual(lib.Plugin.get_data(), {'greeting': 'hello'})
+
 if __name__ == '__main__':
     unittest.main()
@@ -54,6 +54,15 @@ class TestPluginsAptPackages(unittest.TestCase):
         """Test if a package is installed."""
         self.assertTrue(self._apt_packages.package_installed('apt'))
         self.assertFalse(self._apt_packages.package_installed('!kitty'))
+        # listed as "libc6:<architecture>"
+        self.assertTrue(self._apt_packages.package_installed('libc6'))
+
+    def test_installed_packages(self) -> None:
+        """Test which packages are installed."""
+        self.assertEqual(
+                self._apt_packages.installed_packages(['apt', '!kitty']),
+                {'apt'})
+        self.assertEqual(self._apt_packages.installed_packages([]), set())
 
     @unittest.skipUnless(require_interaction,
             'do not require interaction with the user')
@@ -111,6 +111,49 @@ class TestPluginsPaths(unittest.TestCase):
                 pathlib.Path(self._base_dir / 'a').read_text(encoding='utf-8'),
                 'Greetings, oh Admin!')
 
+    def test_run(self) -> None:
+        """Run dependent and independent subtasks."""
+        pathlib.Path(self._base_dir / 't').write_text('$greeting',
+                encoding='utf-8')
+        self._paths.data['variables']['paths'] = [
+            {'path': str(self._base_dir / 'd'), 'ensure': 'dir'},
+            {'path': str(self._base_dir / 'a'), 'ensure': 'file',
+                'template': 'template1', 'permissions': '-'},
+            {'path': str(self._base_dir / 'b'), 'ensure': 'file',
+                'template': 'template1', 'permissions': '-'},
+            {'path': str(self._base_dir / 'a'), 'ensure': 'in_file',
+                'text': ', oh Admin!', 'backup': False},
+            ]
+        self._paths.run()
+        self.assertTrue(pathlib.Path(self._base_dir / 'd').is_dir())
+        self.assertEqual(
+                pathlib.Path(self._base_dir / 'a').read_text(encoding='utf-8'),
+                'Greetings, oh Admin!')
+        self.assertEqual(
+                pathlib.Path(self._base_dir / 'b').read_text(encoding='utf-8'),
+                'Greetings')
+
+    def test_independent(self) -> None:
+        """Find subtasks that touch each other's paths."""
+        self.assertTrue(paths.Paths.independent('/a/b', ['/a/c']))
+        self.assertFalse(paths.Paths.independent('/a/b', ['/a']))
+        self.assertFalse(paths.Paths.independent('/a', ['/a/b']))
+        self.assertFalse(paths.Paths.independent('/a', ['/a']))
+        self.assertTrue(paths.Paths.independent('/ab', ['/a']))
+
+    def test_alone(self) -> None:
+        """Find subtasks that must run on their own."""
+        directory: pathlib.Path = pathlib.Path(
+                os.path.realpath(self._base_dir))
+        (directory / 'd').mkdir()
+        (directory / 'l').symlink_to(directory / 'd')
+        file: dict[str, Any] = {'ensure': 'file'}
+        self.assertFalse(paths.Paths.alone(file, str(directory / 'd/a')))
+        self.assertTrue(paths.Paths.alone(file, str(directory / 'l/a')))
+        self.assertTrue(paths.Paths.alone(file, str(directory / 'l')))
+        self.assertTrue(paths.Paths.alone(
+            {'ensure': 'symlink'}, str(directory / 'a')))
+
     def test_ensure_file_no_template(self) -> None:
         """Fail because no valid template exists."""
         with self.assertRaises(KeyError):